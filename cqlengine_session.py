@@ -26,26 +26,62 @@ foo = Foo.create()
 
 """
 
+import argparse
+from collections import deque, OrderedDict
 import copy
+import cPickle
+import hashlib
 from datetime import date, datetime
 import importlib
 import json
+import math
+import multiprocessing
+import operator
+import os
+import Queue
+import random
+import struct
+import sys
 import threading
+import time
+import traceback
 from uuid import UUID
+import zlib
 
 from cassandra.query import SimpleStatement
 from cqlengine import columns
 import cqlengine.connection
 from cqlengine.exceptions import ValidationError
-from cqlengine.management import get_fields, sync_table
+from cqlengine.management import sync_table
 from cqlengine.models import ColumnQueryEvaluator, Model, ModelMetaClass
-from cqlengine.operators import EqualsOperator
-from cqlengine.query import BatchQuery, ModelQuerySet
+from cqlengine.operators import EqualsOperator, InOperator, GreaterThanOperator, GreaterThanOrEqualOperator, LessThanOperator, LessThanOrEqualOperator
+from cqlengine.query import BatchQuery, BatchType, ModelQuerySet, QueryException
 from cqlengine.statements import WhereClause, SelectStatement, DeleteStatement, UpdateStatement, AssignmentClause, InsertStatement, BaseCQLStatement, MapUpdateClause, MapDeleteClause, ListUpdateClause, SetUpdateClause, CounterUpdateClause
 
 
 class AttributeUnavailable(Exception):
-    pass
+    """Raised reading a column an instance holds no value for.
+
+    args are (instance, column name).  Blind instances hold only what was
+    set on them, and instances loaded with only() or defer() only the
+    columns that were selected.
+
+    """
+
+    def __str__(self):
+        if len(self.args) != 2:
+            return super(AttributeUnavailable, self).__str__()
+        instance, name = self.args
+        if instance._partial:
+            reason = 'was not selected by the only() or defer() query that loaded it'
+        else:
+            reason = 'has not been loaded or set'
+        return '{}{!r} column {!r} {} (loaded: {})'.format(
+                instance.__class__.__name__,
+                instance.key,
+                name,
+                reason,
+                ', '.join(sorted(instance.loaded_columns())))
 
 
 class SessionManager(object):
@@ -69,14 +105,83 @@ class ThreadLocalSessionManager(SessionManager):
         self.storage.session = session
 
 
+class SharedSessionManager(SessionManager):
+    """Give every thread the same session, see ConcurrentSession.
+
+    factory makes the session, and a new one whenever clear() is called.
+
+    """
+    def __init__(self, factory=None):
+        self.factory = factory or ConcurrentSession
+        self.session = self.factory()
+
+    def get_session(self):
+        return self.session
+
+    def set_session(self, session):
+        if session is None:
+            session = self.factory()
+        self.session = session
+
+
 SESSION_MANAGER = ThreadLocalSessionManager()
 
+# How much validation writes get.  VALIDATE_KEYS keeps only the checks that
+# required and primary key columns are not null, VALIDATE_NONE trusts the
+# values completely, for rows that are already valid (e.g. just read from
+# Cassandra.)
+VALIDATE_ALL = 'all'
+VALIDATE_KEYS = 'keys'
+VALIDATE_NONE = 'none'
+VALIDATIONS = (VALIDATE_ALL, VALIDATE_KEYS, VALIDATE_NONE)
+
 
 def set_session_manager(manager):
     global SESSION_MANAGER
     SESSION_MANAGER = manager
 
 
+def set_session_factory(factory):
+    """Make get_session() create new sessions by calling factory."""
+    global SESSION_FACTORY
+    SESSION_FACTORY = factory
+
+
+# Keys per IN query loading the rows of WrappedQuerySet.prefetch().
+PREFETCH_CHUNK_SIZE = 100
+
+
+# The QueryCache used by every session, if any.
+QUERY_CACHE = None
+
+
+def set_query_cache(cache):
+    """Cache query results in cache, a QueryCache, or stop if None."""
+    global QUERY_CACHE
+    QUERY_CACHE = cache
+
+
+# The NegativeCache or BloomNegativeCache used by every session, if any.
+NEGATIVE_CACHE = None
+
+
+def set_negative_cache(cache):
+    """Share the keys get() finds missing through cache, or stop if None."""
+    global NEGATIVE_CACHE
+    NEGATIVE_CACHE = cache
+
+
+# The PartitionCache used by every session, if any.
+PARTITION_CACHE = None
+
+
+def set_partition_cache(cache):
+    """Cache the first rows of partitions in cache, a PartitionCache, or
+    stop if None."""
+    global PARTITION_CACHE
+    PARTITION_CACHE = cache
+
+
 def clear():
     """Empty the current session"""
     # xxx what happens to the existing id-map objects?  this is dangerous.
@@ -84,134 +189,2082 @@ def clear():
     SESSION_MANAGER.set_session(None)
 
 
-def save(*objects):
+def save(*objects, **kwargs):
     "Write all pending changes from session to Cassandra."
     session = SESSION_MANAGER.get_session()
     if session is not None:
-        session.save(*objects)
+        return session.save(*objects, **kwargs)
+
+
+def wait():
+    """Wait for the current session's background flushes, if any."""
+    session = SESSION_MANAGER.get_session()
+    if session is not None:
+        session.wait()
 
 
 def get_session(create_if_missing=True):
     session = SESSION_MANAGER.get_session()
     if session is None:
-        session = Session()
+        session = SESSION_FACTORY()
         SESSION_MANAGER.set_session(session)
     return session
 
 
+def _journal():
+    """Return the current session's journal, if any."""
+    session = SESSION_MANAGER.get_session()
+    if session is not None:
+        return session.journal
+
+
 def add_call_after_save(callable, *args, **kwargs):
     """Call callable with given args and kwargs after next save."""
-    get_session().call_after_save.append((callable, args, kwargs,))
+    get_session()._add_call_after_save((callable, args, kwargs,))
 
 
 class Session(object):
     """Identity map objects and support for implicit batch save."""
-    def __init__(self):
+
+    # The striped locks of a ConcurrentSession.
+    locks = None
+
+    def __init__(self, journal=None, group_commit=None, write_behind=False,
+                 validation=VALIDATE_ALL, validate_sample=0.0):
+        """
+        journal -- optional Journal recording the unsaved changes
+        group_commit -- optional GroupCommitter shared with other sessions
+        write_behind -- if True, save() writes on a background thread and
+                        returns a FlushFuture
+        validation -- VALIDATE_ALL, VALIDATE_KEYS or VALIDATE_NONE
+        validate_sample -- fraction of rows given VALIDATE_ALL anyway
+        """
+        if journal is not None and write_behind:
+            # The journal is emptied as a save returns, which would lose
+            # the changes of a background flush that then fails.
+            raise ValueError('A journal cannot be used with write_behind')
         self.instances_by_class = {}
         self.call_after_save = []
-        #self.deletes = set()
+        # (model class, partition, where clauses, instance, filters) for each
+        # pending delete, in the order they were requested.  Row deletes
+        # have an instance, range deletes have the delete_range() filters.
+        self.deletes = []
+        # Model class -> primary keys (in database form) get() found missing.
+        self.missing = {}
+        # (model class, partition) -> [(prefix, lower, upper)] for each
+        # slice of the partition loaded completely, see _key_range().
+        self.loaded_ranges = {}
+        self.journal = journal
+        self.group_commit = group_commit
+        self.write_behind = write_behind
+        _check_validation(validation)
+        self.validation = validation
+        self.validate_sample = validate_sample
+        # FlushFutures of background flushes not yet seen to finish.
+        self.flushes = []
+        self._worker = None
+
+    def is_missing(self, model_class, key):
+        """Return whether get() found key, in database form, missing."""
+        missing = self.missing.get(model_class)
+        if missing is not None and key in missing:
+            return True
+        cache = NEGATIVE_CACHE
+        return cache is not None and cache.contains(
+                model_class.id_mapped_class.column_family_name(), key)
+
+    def add_missing(self, model_class, key):
+        try:
+            self.missing[model_class].add(key)
+        except KeyError:
+            self.missing[model_class] = set([key])
+        if NEGATIVE_CACHE is not None:
+            NEGATIVE_CACHE.add(model_class.id_mapped_class.column_family_name(), key)
+
+    def forget_missing(self, instance):
+        """Forget that instance's row was missing, it is being written."""
+        key = _database_key(instance)
+        missing = self.missing.get(instance.__class__)
+        if missing is not None:
+            missing.discard(key)
+        if NEGATIVE_CACHE is not None:
+            NEGATIVE_CACHE.discard(
+                    instance.id_mapped_class.column_family_name(), key)
+
+    def _record_loaded(self, model_class, key_range):
+        partition, prefix, lower, upper = key_range
+        try:
+            self.loaded_ranges[(model_class, partition)].append((prefix, lower, upper))
+        except KeyError:
+            self.loaded_ranges[(model_class, partition)] = [(prefix, lower, upper)]
+
+    def _is_loaded(self, model_class, key_range):
+        """Return whether every row in key_range is in the identity map."""
+        partition, prefix, lower, upper = key_range
+        for loaded in self.loaded_ranges.get((model_class, partition), ()):
+            if _range_covers(loaded, (prefix, lower, upper)):
+                return True
+        return False
+
+    def _owns(self, instance):
+        """Return whether instance is in this session's identity map."""
+        by_key = self.instances_by_class.get(instance.__class__)
+        return by_key is not None and by_key.get(instance.key) is instance
+
+    def delete(self, instance):
+        """Delete instance's row at the next save.
+
+        The instance leaves the identity map right away, along with any
+        pending changes it had.
 
-    def save(self, *objects):
+        """
+        cls = instance.__class__
+        by_key = self.instances_by_class.get(cls)
+        if by_key is not None and by_key.get(instance.key) is instance:
+            del by_key[instance.key]
+        _discard_pending(instance)
+        self.deletes.append((cls,
+                             _partition(instance),
+                             _primary_key_where(instance),
+                             instance,
+                             None))
+        if self.journal is not None:
+            self.journal.record_delete(instance)
+
+    def delete_range(self, model_class, **kwargs):
+        """Delete the rows of model_class matching kwargs at the next save.
+
+        kwargs must give every partition key with an equality, and may then
+        give a prefix of the clustering keys with equalities, optionally
+        followed by a range (__gt, __gte, __lt, __lte) on the next clustering
+        key.  Deleting less than a whole partition needs Cassandra 3.0 or
+        later.
+
+        Matching instances leave the identity map right away.
+
+        """
+        model = model_class.id_mapped_class
+        where = model_class.objects.filter(**kwargs)._where
+        by_field = {}
+        for clause in where:
+            by_field.setdefault(clause.field, []).append(clause)
+        partition = []
+        for name, col in model._partition_keys.items():
+            clauses = by_field.pop(col.db_field_name, ())
+            if len(clauses) != 1 or type(clauses[0].operator) is not EqualsOperator:
+                raise QueryException(
+                        "Range deletes need an equality on partition key '{}'".format(name))
+            partition.append(clauses[0].value)
+        in_range = False
+        for name, col in model._clustering_keys.items():
+            clauses = by_field.pop(col.db_field_name, ())
+            if not clauses:
+                in_range = True
+            elif in_range:
+                raise QueryException(
+                        "Range deletes can't restrict '{}' after an unrestricted or ranged clustering key".format(name))
+            elif all(type(c.operator) in _RANGE_OPERATORS for c in clauses):
+                in_range = True
+            elif len(clauses) != 1 or type(clauses[0].operator) is not EqualsOperator:
+                raise QueryException(
+                        "Range deletes need an equality or a range on clustering key '{}'".format(name))
+        if by_field:
+            raise QueryException(
+                    "Range deletes can only restrict primary keys, not {}".format(
+                        ', '.join(by_field)))
+
+        by_key = self.instances_by_class.get(model_class, {})
+        for key, instance in by_key.items():
+            if _matches(instance, where):
+                by_key.pop(key, None)
+                _discard_pending(instance)
+        self.deletes.append((model_class, tuple(partition), where, None, kwargs))
+        if self.journal is not None:
+            self.journal.record_delete_range(model_class, kwargs)
+
+    def save(self, *objects, **kwargs):
         """Flush all pending changes to Cassandra.
 
         objects -- if not None, only operate on this or these object(s)
+        dependencies -- if True, also operate on every object reachable from
+                        objects through depends_on()
+        validation, validate_sample -- override the session's, for this save
+
+        Every insert and update written by one flush carries the same client
+        timestamp, so the order the statements reach Cassandra in does not
+        matter.
+
+        With write_behind, the statements are built right away and written
+        by a background thread; changes made meanwhile are left for the next
+        save.  Returns a FlushFuture.  The changes of a failed background
+        flush are marked pending again by the next save() or wait().
+        Without write_behind, a failed save() marks its changes pending
+        again before raising.
 
         """
-        updates = set()
-        counter_updates = set()
-        creates = set()
-        counter_creates = set()
-        for model_class, by_key in self.instances_by_class.iteritems():
-            for key, instance in by_key.iteritems():
-                if hasattr(instance, '_created') and instance._created:
-                    if model_class.id_mapped_class._has_counter:
-                        counter_creates.add(instance)
-                    else:
-                        creates.add(instance)
-                elif hasattr(instance, '_dirties'):
-                    if model_class.id_mapped_class._has_counter:
-                        counter_updates.add(instance)
-                    else:
-                        updates.add(instance)
-        if objects:
-            updates = updates and objects
-            counter_updates = counter_updates and objects
-            creates = creates and objects
-            counter_creates = counter_creates and objects
-
-        with BatchQuery() as batch:
-            for create in creates:
-                # Note we skip a lot of cqlengine code and create the
-                # insert statement directly.
-                # (this is the non-optimized code that is replaced below)
-                #key_names = create.id_mapped_class._columns.keys()
-                #arg = {name: getattr(create, name) for name in key_names}
-                #create.id_mapped_class.batch(batch).create(**arg)
-                # (end non-optimized code)
-                # (begin optimized)
-                # note: it might save time to memoize column family name
-                # note: cqlengine-session doesn't yet support 'ttl'
-                insert = InsertStatement(create.id_mapped_class.column_family_name())#, ttl=self._ttl)
-                for name, col in create.id_mapped_class._columns.items():
-                    val = col.validate(getattr(create, name))
-                    if col._val_is_null(val):
-                        continue
-                    insert.add_assignment_clause(AssignmentClause(
-                        col.db_field_name,
-                        col.to_database(val)))
-                # skip query execution if it's empty
-                # caused by pointless update queries
-                if not insert.is_empty:
-                    batch.add_query(insert)
-                # (end optimized)
-                del create._created
+        follow_dependencies = kwargs.pop('dependencies', False)
+        validation = kwargs.pop('validation', self.validation)
+        validate_sample = kwargs.pop('validate_sample', self.validate_sample)
+        _check_validation(validation)
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments to save: {}'.format(
+                    ', '.join(kwargs)))
+        if objects and follow_dependencies:
+            objects = _with_dependencies(objects)
+        if self.flushes:
+            self._collect_flushes()
+        flush = self._prepare_flush(objects, validation, validate_sample)
+        if self.write_behind:
+            future = FlushFuture(flush, self._take_call_after_save())
+            self._submit(future)
+            return future
+        try:
+            self._write(flush)
+        except Exception:
+            # Keep the changes pending, for the next save.
+            self._restore(flush)
+            raise
+        if self.journal is not None:
+            if objects:
+                # Other changes are still pending, keep only those.
+                self.journal.rewrite(self)
+            else:
+                self.journal.truncate()
+        for callable, args, kwargs in self._take_call_after_save():
+            callable(*args, **kwargs)
+
+    def _add_call_after_save(self, call):
+        self.call_after_save.append(call)
+
+    def _take_call_after_save(self):
+        """Return the calls to make after this save, and forget them."""
+        calls = self.call_after_save
+        self.call_after_save = []
+        return calls
+
+    def _submit(self, future):
+        """Hand a FlushFuture to the background thread."""
+        if self._worker is None:
+            self._worker = _FlushWorker(self._write)
+        self._worker.submit(future)
+        self.flushes.append(future)
+
+    def wait(self):
+        """Wait for the background flushes, and raise the first error.
+
+        The changes of failed flushes are marked pending again first.
+
+        """
+        for future in self.flushes:
+            future.wait()
+        error = self._collect_flushes()
+        if error is not None:
+            raise error
+
+    def _write(self, flush):
+        if self.group_commit is not None:
+            self.group_commit.commit(flush)
+        else:
+            flush.execute()
+        if QUERY_CACHE is not None:
+            QUERY_CACHE.invalidate(*flush.tables())
+        if PARTITION_CACHE is not None:
+            PARTITION_CACHE.apply(flush)
+
+    def _collect_flushes(self):
+        """Forget finished background flushes and return the first error.
+
+        The changes of failed flushes are marked pending again, under any
+        made since.
+
+        """
+        running = []
+        failed = []
+        for future in self.flushes:
+            if not future.done():
+                running.append(future)
+            elif future.flush is not None:
+                failed.append(future)
+        self.flushes = running
+        # Newest first, so older deletes end up ahead of newer ones.
+        for future in reversed(failed):
+            self._restore(future.flush)
+        if failed:
+            return failed[0].error
+
+    def _restore(self, flush):
+        """Mark the changes written by a failed flush as pending again."""
+        for instance, ttl in flush.creates:
+            if self._owns(instance):
+                with instance._lock or _NO_LOCK:
+                    instance._created = True
+                    if instance._ttl is None:
+                        instance._ttl = ttl
+        for instance in flush.counter_creates:
+            if self._owns(instance):
+                instance._created = True
+        for instance, dirties, ttl in flush.updates:
+            if not self._owns(instance):
+                continue
+            with instance._lock or _NO_LOCK:
                 try:
-                    del create._dirties
+                    current = instance._dirties
                 except AttributeError:
-                    pass
-            for update in updates:
-                key_names = update._primary_keys.keys()
-                arg = {name: getattr(update, name) for name in key_names}
-                dirties = update._dirties
-                update.id_mapped_class.objects(**arg).batch(batch).update(**dirties)
-                del update._dirties
-        # It would seem that batch does not work with counter?
-        #with BatchQuery() as batch:
-        for create in counter_creates:
-            primary_key_names = create.id_mapped_class._primary_keys.keys()
-            arg = {name: getattr(create, name) for name in primary_key_names}
-            instance = create.id_mapped_class.create(**arg)
+                    current = instance._dirties = {}
+                for name in dirties:
+                    if name not in current:
+                        # The current value, in case a later flush wrote a
+                        # newer one.
+                        current[name] = getattr(instance, name)
+                if instance._ttl is None:
+                    instance._ttl = ttl
+        for instance, dirties in flush.counter_updates:
+            if not self._owns(instance):
+                continue
+            with instance._lock or _NO_LOCK:
+                try:
+                    current = instance._dirties
+                except AttributeError:
+                    current = instance._dirties = {}
+                for name, delta in dirties.items():
+                    current[name] = current.get(name, 0) + delta
+        deletes = []
+        for delete in flush.deletes:
+            instance = delete[3]
+            if instance is not None:
+                by_key = self.instances_by_class.get(delete[0])
+                if by_key is not None and instance.key in by_key:
+                    # The row was created or loaded again since.
+                    continue
+            deletes.append(delete)
+        self.deletes[:0] = deletes
+
+    def _prepare_flush(self, objects, validation=VALIDATE_ALL, validate_sample=0.0):
+        """Return a Flush writing the pending changes of objects, or all.
+
+        The changes are taken off the instances, so that changes made after
+        this call are left for the next flush.
+
+        """
+        updates = []
+        counter_updates = []
+        creates = []
+        counter_creates = []
+        if objects:
+            # Look the given objects up directly rather than scanning the
+            # identity map, so this costs only as much as what's asked for.
+            instances = [o for o in objects if self._owns(o)]
+        else:
+            instances = [instance
+                         for by_key in self.instances_by_class.values()
+                         for instance in by_key.values()]
+        for instance in instances:
+            with instance._lock or _NO_LOCK:
+                pending = _take_pending(instance)
+            if pending is None:
+                continue
+            created, dirties, ttl = pending
+            if created:
+                if instance.id_mapped_class._has_counter:
+                    counter_creates.append((instance, dirties))
+                else:
+                    creates.append((instance, ttl))
+            elif instance.id_mapped_class._has_counter:
+                counter_updates.append((instance, dirties))
+            else:
+                updates.append((instance, dirties, ttl))
+
+        if self.missing or NEGATIVE_CACHE is not None:
+            # Writing a row makes it exist.
+            for pending in (creates, counter_creates, updates, counter_updates):
+                for entry in pending:
+                    self.forget_missing(entry[0])
+
+        flush = Flush()
+        flush.deletes = self._take_deletes(objects)
+        flush.creates = creates
+        flush.counter_creates = [create for create, values in counter_creates]
+        flush.updates = updates
+        flush.counter_updates = counter_updates
+        try:
+            self._flush_statements(flush, counter_creates, validation,
+                                   validate_sample)
+        except Exception:
+            # Keep the changes for the next save.
+            self._restore(flush)
+            raise
+        return flush
+
+    def _flush_statements(self, flush, counter_creates, validation,
+                          validate_sample):
+        """Add the statements writing the changes flush took to it.
+
+        counter_creates -- (instance, counter values) for each counter row
+                           created
+
+        """
+        deletes = flush.deletes
+        timestamp = _client_timestamp()
+        # Deletes are applied just before the rest of the flush, so that a
+        # row created again after its delete was queued survives it.
+        delete_statements, counter_delete_statements = _delete_statements(
+                deletes, timestamp - 1)
+        flush.statements.extend(delete_statements)
+        flush.counter_statements.extend(counter_delete_statements)
+        for create, ttl in flush.creates:
+            # Note we skip a lot of cqlengine code and create the
+            # insert statement directly.
+            # (this is the non-optimized code that is replaced below)
+            #key_names = create.id_mapped_class._columns.keys()
+            #arg = {name: getattr(create, name) for name in key_names}
+            #create.id_mapped_class.batch(batch).create(**arg)
+            # (end non-optimized code)
+            # (begin optimized)
+            # note: it might save time to memoize column family name
+            insert = SessionInsertStatement(
+                    create.id_mapped_class.column_family_name(),
+                    ttl=create._get_ttl(ttl),
+                    timestamp=timestamp)
+            level = _row_validation(validation, validate_sample)
+            # The row as a query would return it, unless it expires.
+            row = {} if PARTITION_CACHE is not None and insert.ttl is None else None
             for name, col in create.id_mapped_class._columns.items():
-                if isinstance(col, columns.Counter):
-                    val = getattr(create, name)
-                    setattr(instance, name, val)
-            del create._created
+                val = getattr(create, name)
+                if level == VALIDATE_ALL:
+                    val = col.validate(val)
+                elif level == VALIDATE_KEYS:
+                    _check_not_null(col, val)
+                if row is not None:
+                    if col._val_is_null(val):
+                        row[col.db_field_name] = None
+                    elif isinstance(col, columns.BaseContainerColumn):
+                        # A copy, the instance's may change before the
+                        # flush is written.
+                        row[col.db_field_name] = col.to_python(val)
+                    else:
+                        row[col.db_field_name] = val
+                if col._val_is_null(val):
+                    continue
+                insert.add_assignment_clause(AssignmentClause(
+                    col.db_field_name,
+                    col.to_database(val)))
+            # skip query execution if it's empty
+            # caused by pointless update queries
+            if not insert.is_empty:
+                partition = _partition_of(create)
+                flush.statements.append((partition, insert))
+                if row is not None:
+                    flush.rows.append((partition, insert, create.id_mapped_class, row))
+            # (end optimized)
+        for update, dirties, ttl in flush.updates:
+            partition = _partition_of(update)
+            level = _row_validation(validation, validate_sample)
+            for statement in _update_statements(
+                    update, dirties, update._get_ttl(ttl), timestamp, level):
+                flush.statements.append((partition, statement))
+        # Note: Cassandra does not accept a client timestamp or a ttl on
+        # counter updates, so counters are written without them.
+        for create, values in counter_creates:
+            flush.counter_statements.append(
+                    (_partition_of(create), _counter_statement(create, values)))
+        for update, dirties in flush.counter_updates:
+            flush.counter_statements.append(
+                    (_partition_of(update), _counter_statement(update, dirties)))
+
+    def _take_deletes(self, objects):
+        """Return the pending deletes of objects, or all, and forget them."""
+        if objects:
+            deletes = [d for d in self.deletes if d[3] in objects]
+            self.deletes = [d for d in self.deletes if d[3] not in objects]
+        else:
+            deletes = self.deletes
+            self.deletes = []
+        return deletes
+
+
+class ConcurrentSession(Session):
+    """A Session that threads can share, see SharedSessionManager.
+
+    The identity map is guarded by lock striping: each (model class, key)
+    hashes to one of stripes locks, held while the instance is looked up or
+    made.  That lock then guards the instance's changes, and save() takes
+    them off the instance under it, so a change made meanwhile is either in
+    the flush or left for the next one.  The session's own lists are
+    guarded by one lock, held only while they are changed.
+
+    Changes to the same instance from several threads still race like any
+    other shared object's; only the session's bookkeeping is protected.
+    A journal cannot be used.
+
+    """
+
+    def __init__(self, stripes=64, **kwargs):
+        if kwargs.get('journal') is not None:
+            raise ValueError('A journal cannot be used with a ConcurrentSession')
+        super(ConcurrentSession, self).__init__(**kwargs)
+        self.locks = [threading.RLock() for i in xrange(stripes)]
+        self._lock = threading.RLock()
+
+    def _locked_instance(self, cls, key):
+        """Return the instance of cls for key, made if need be, see
+        IdMapMetaClass.__call__()."""
+        lock = self.locks[hash((cls, key)) % len(self.locks)]
+        with lock:
+            instance_by_key = self.instances_by_class.get(cls)
+            if instance_by_key is None:
+                instance_by_key = self.instances_by_class.setdefault(cls, {})
+            try:
+                return instance_by_key[key]
+            except KeyError:
+                pass
+            instance = type.__call__(cls, *key)
+            instance._lock = lock
+            instance_by_key[key] = instance
+            return instance
+
+    def add_missing(self, model_class, key):
+        with self._lock:
+            super(ConcurrentSession, self).add_missing(model_class, key)
+
+    def _record_loaded(self, model_class, key_range):
+        with self._lock:
+            super(ConcurrentSession, self)._record_loaded(model_class, key_range)
+
+    def delete(self, instance):
+        with self._lock:
+            super(ConcurrentSession, self).delete(instance)
+
+    def delete_range(self, model_class, **kwargs):
+        with self._lock:
+            super(ConcurrentSession, self).delete_range(model_class, **kwargs)
+
+    def _take_deletes(self, objects):
+        with self._lock:
+            return super(ConcurrentSession, self)._take_deletes(objects)
+
+    def _add_call_after_save(self, call):
+        with self._lock:
+            self.call_after_save.append(call)
+
+    def _take_call_after_save(self):
+        with self._lock:
+            return super(ConcurrentSession, self)._take_call_after_save()
+
+    def _submit(self, future):
+        with self._lock:
+            super(ConcurrentSession, self)._submit(future)
+
+    def _collect_flushes(self):
+        with self._lock:
+            return super(ConcurrentSession, self)._collect_flushes()
+
+    def _restore(self, flush):
+        with self._lock:
+            super(ConcurrentSession, self)._restore(flush)
+
+
+SESSION_FACTORY = Session
+
+
+class Flush(object):
+    """The statements written by one save.
+
+    statements and counter_statements are lists of (partition, statement),
+    where partition is (column family name, partition key values).  The
+    other lists record what was taken off the instances, so that it can be
+    put back if the flush fails.
+
+    """
+
+    def __init__(self):
+        self.statements = []
+        self.counter_statements = []
+        self.creates = []  # (instance, ttl)
+        self.counter_creates = []
+        self.updates = []  # (instance, dirties, ttl)
+        self.counter_updates = []  # (instance, dirties)
+        self.deletes = []
+        # (partition, statement, model, row) for each create the PARTITION_CACHE
+        # can merge.
+        self.rows = []
+
+    def tables(self):
+        """Return the names of the column families written to."""
+        return set(partition[0]
+                   for partition, statement in self.statements + self.counter_statements)
+
+    def execute(self):
+        """Write statements as one logged batch, then each counter statement."""
+        # It would seem that batch does not work with counter?
+        if self.statements:
+            batch = BatchQuery()
+            for partition, statement in self.statements:
+                batch.add_query(statement)
+            batch.execute()
+        for partition, statement in self.counter_statements:
+            cqlengine.connection.execute(statement)
+
+
+class FlushFuture(object):
+    """The outcome of a save() written in the background."""
+
+    def __init__(self, flush, callbacks):
+        # Dropped once written, so what is left is the failed flush.
+        self.flush = flush
+        self.callbacks = callbacks
+        self.error = None
+        self._done = threading.Event()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for the flush to finish, return whether it has."""
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def result(self):
+        """Wait for the flush to finish, and raise its error, if any."""
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+
+
+class _FlushWorker(object):
+    """Write FlushFutures in order, on a thread that exits when idle.
+
+    The thread is a daemon, call wait() before exiting the process.
+
+    """
+
+    def __init__(self, write):
+        self.write = write
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._running = False
+
+    def submit(self, future):
+        with self._lock:
+            self._queue.append(future)
+            if self._running:
+                return
+            self._running = True
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._queue:
+                    self._running = False
+                    return
+                future = self._queue.popleft()
+            try:
+                self.write(future.flush)
+                future.flush = None
+                # Note: callbacks run on this thread, where get_session()
+                # is not the session that saved.
+                for callable, args, kwargs in future.callbacks:
+                    callable(*args, **kwargs)
+            except Exception, e:
+                future.error = e
+            finally:
+                future._done.set()
+
+
+class GroupCommitter(object):
+    """Write the flushes of concurrent sessions together.
+
+    The first session to commit waits up to window seconds for others to
+    join it, then writes everybody's statements as one batch per partition,
+    sent concurrently, and wakes each session with its own outcome.  Client
+    timestamps make the merged statements safe to reorder.  Unlike
+    Flush.execute(), a flush spanning partitions is not written atomically.
+
+    use: set_session_factory(lambda: Session(group_commit=committer))
+    with one committer shared by every thread.
+
+    """
+
+    def __init__(self, window=0.002, max_statements=500):
+        """
+        window -- seconds to wait for other sessions to join a group
+        max_statements -- write a group as soon as it has this many
+        """
+        self.window = window
+        self.max_statements = max_statements
+        self._condition = threading.Condition()
+        self._group = None
+        self._group_size = 0
+
+    def commit(self, flush):
+        """Write flush along with others, and raise its error, if any."""
+        if not flush.statements and not flush.counter_statements:
+            # Nothing to write, so nothing to wait for.
+            return
+        entry = _GroupCommitEntry(flush)
+        with self._condition:
+            group = self._group
+            is_leader = group is None
+            if is_leader:
+                group = self._group = []
+                self._group_size = 0
+            group.append(entry)
+            self._group_size += len(flush.statements) + len(flush.counter_statements)
+            if self._group_size >= self.max_statements:
+                self._condition.notify_all()
+        if is_leader:
+            deadline = time.time() + self.window
+            with self._condition:
+                while self._group_size < self.max_statements:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                self._group = None
+            try:
+                self._write(group)
+            except Exception, e:
+                # Failed before every flush had its own outcome: the others
+                # share the error, rather than seeing success.
+                for other in group:
+                    if other.error is None:
+                        other.error = e
+            finally:
+                for other in group:
+                    other.done.set()
+        else:
+            entry.done.wait()
+        if entry.error is not None:
+            raise entry.error
+
+    def _write(self, group):
+        by_partition = OrderedDict()
+        for entry in group:
+            for is_counter, statements in ((False, entry.flush.statements),
+                                           (True, entry.flush.counter_statements)):
+                for partition, statement in statements:
+                    try:
+                        items = by_partition[(is_counter, partition)]
+                    except KeyError:
+                        items = by_partition[(is_counter, partition)] = []
+                    items.append((statement, entry))
+        session = cqlengine.connection.get_session()
+        futures = []
+        for (is_counter, partition), items in by_partition.items():
+            batch_type = BatchType.Counter if is_counter else BatchType.Unlogged
+            try:
+                query, params = _batch_query([s for s, e in items], batch_type)
+                future = session.execute_async(query, params)
+            except Exception, e:
+                future = None
+                error = e
+            futures.append((future, error if future is None else None, items))
+        for future, error, items in futures:
+            if future is not None:
+                try:
+                    future.result()
+                except Exception, e:
+                    error = e
+            if error is not None:
+                for statement, entry in items:
+                    if entry.error is None:
+                        entry.error = error
+
+
+class _GroupCommitEntry(object):
+
+    def __init__(self, flush):
+        self.flush = flush
+        self.error = None
+        self.done = threading.Event()
+
+
+def _batch_query(statements, batch_type):
+    """Return (SimpleStatement, params) writing statements together."""
+    if len(statements) == 1:
+        statement = statements[0]
+        params = statement.get_context()
+        query = unicode(statement)
+    else:
+        lines = ['BEGIN {} BATCH'.format(batch_type)]
+        params = {}
+        context_id = 0
+        for statement in statements:
+            statement.update_context_id(context_id)
+            context = statement.get_context()
+            context_id += len(context)
+            lines.append('  ' + unicode(statement))
+            params.update(context)
+        lines.append('APPLY BATCH;')
+        query = '\n'.join(lines)
+    return (SimpleStatement(query,
+                            consistency_level=cqlengine.connection.default_consistency_level),
+            params)
+
+
+def _counter_statement(instance, increments):
+    """Return an UpdateStatement adding increments to instance's counters."""
+    statement = UpdateStatement(instance.id_mapped_class.column_family_name())
+    for name, value in increments.items():
+        col = instance.id_mapped_class._columns[name]
+        clause = CounterUpdateClause(col.db_field_name, value, 0, column=col)
+        statement.add_assignment_clause(clause)
+    for clause in _primary_key_where(instance):
+        statement.add_where_clause(clause)
+    return statement
+
+
+def _check_validation(validation):
+    if validation not in VALIDATIONS:
+        raise ValueError('validation must be one of {}, not {!r}'.format(
+                ', '.join(VALIDATIONS), validation))
+
+
+def _row_validation(validation, validate_sample):
+    """Return the validation for one row, VALIDATE_ALL if it is sampled."""
+    if validate_sample and random.random() < validate_sample:
+        return VALIDATE_ALL
+    return validation
+
+
+def _check_not_null(col, value):
+    """The VALIDATE_KEYS check: required and primary key columns have values."""
+    if (col.required or col.primary_key) and col._val_is_null(value):
+        raise ValidationError('{} - None values are not allowed'.format(
+                col.column_name or col.db_field))
+
+
+# The last timestamp _client_timestamp() returned.
+_LAST_TIMESTAMP = 0
+_TIMESTAMP_LOCK = threading.Lock()
+
+
+def _client_timestamp():
+    """Return the current time in microseconds, for USING TIMESTAMP.
+
+    Each call returns more than the last, even within a microsecond or
+    after the clock is set back, so later flushes always win.
+
+    """
+    global _LAST_TIMESTAMP
+    now = long(time.time() * 1e6)
+    with _TIMESTAMP_LOCK:
+        _LAST_TIMESTAMP = max(now, _LAST_TIMESTAMP + 1)
+        return _LAST_TIMESTAMP
+
+
+def _update_statements(instance, dirties, ttl, timestamp, validation=VALIDATE_ALL):
+    """Return the statements that write dirties, instance's dirty values.
+
+    Columns set to None are removed with a DeleteStatement carrying the same
+    timestamp, so the update and the delete cannot be reordered.
+
+    """
+    model = instance.id_mapped_class
+    column_family_name = model.column_family_name()
+    statement = UpdateStatement(column_family_name,
+                                ttl=ttl,
+                                timestamp=timestamp)
+    nulled_fields = []
+    for name, value in dirties.items():
+        col = model._columns[name]
+        if col.primary_key:
+            raise ValidationError(
+                    "Cannot apply update to primary key '{}' for {}".format(
+                        name, instance.__class__.__name__))
+        if validation == VALIDATE_ALL:
+            value = col.validate(value)
+        elif validation == VALIDATE_KEYS:
+            _check_not_null(col, value)
+        if value is None:
+            nulled_fields.append(col.db_field_name)
+            continue
+        if isinstance(col, columns.BaseContainerColumn):
+            if isinstance(col, columns.List):
+                klass = ListUpdateClause
+            elif isinstance(col, columns.Set):
+                klass = SetUpdateClause
+            elif isinstance(col, columns.Map):
+                klass = MapUpdateClause
+            else:
+                raise RuntimeError
+            clause = klass(col.db_field_name, col.to_database(value))
+        else:
+            clause = AssignmentClause(col.db_field_name, col.to_database(value))
+        statement.add_assignment_clause(clause)
+    statements = []
+    if statement.assignments:
+        for clause in _primary_key_where(instance):
+            statement.add_where_clause(clause)
+        statements.append(statement)
+    if nulled_fields:
+        statements.append(DeleteStatement(column_family_name,
+                                          fields=nulled_fields,
+                                          where=_primary_key_where(instance),
+                                          timestamp=timestamp))
+    return statements
+
+
+def _with_dependencies(objects):
+    """Return objects and everything reachable from them via depends_on()."""
+    found = set()
+    stack = list(objects)
+    while stack:
+        instance = stack.pop()
+        if instance not in found:
+            found.add(instance)
+            stack.extend(getattr(instance, '_dependencies', ()))
+    return found
+
+
+def _delete_statements(deletes, timestamp):
+    """Return (statements, counter statements) performing deletes.
+
+    Each is a list of (partition, statement), as in Flush.
+
+    Deletes are grouped by partition, and a whole-partition delete makes the
+    other deletes queued for its partition unnecessary.  Counter tables don't
+    accept a timestamp, so their deletes are returned separately.
+
+    """
+    by_partition = OrderedDict()
+    for model_class, partition, where, instance, kwargs in deletes:
+        group_key = (model_class, partition)
+        try:
+            group = by_partition[group_key]
+        except KeyError:
+            group = by_partition[group_key] = []
+        if group and group[0] is None:
+            # The whole partition is already being deleted.
+            continue
+        if len(where) == len(partition):
+            by_partition[group_key] = [None]
+        elif where not in group:
+            group.append(where)
+
+    statements = []
+    counter_statements = []
+    for (model_class, partition), group in by_partition.items():
+        model = model_class.id_mapped_class
+        column_family_name = model.column_family_name()
+        statement_partition = (column_family_name, partition)
+        for where in group:
+            if where is None:
+                where = [WhereClause(col.db_field_name, EqualsOperator(), value)
+                         for col, value in zip(model._partition_keys.values(),
+                                               partition)]
+            if model._has_counter:
+                counter_statements.append((statement_partition, DeleteStatement(
+                        column_family_name,
+                        where=where)))
+            else:
+                statements.append((statement_partition, DeleteStatement(
+                        column_family_name,
+                        where=where,
+                        timestamp=timestamp)))
+    return statements, counter_statements
+
+
+def _discard_pending(instance):
+    """Forget instance's unsaved changes."""
+    with instance._lock or _NO_LOCK:
+        for name in ('_created', '_dirties'):
             try:
-                del create._dirties
+                delattr(instance, name)
             except AttributeError:
                 pass
-            instance.update()
-        for update in counter_updates:
-            statement = UpdateStatement(update.id_mapped_class.column_family_name())#, ttl=self._ttl)
-            for name, value in update._dirties.items():
-                col = update.id_mapped_class._columns[name]
-                clause = CounterUpdateClause(col.db_field_name, value, 0, column=col)
-                statement.add_assignment_clause(clause)
-            for name, col in update.id_mapped_class._primary_keys.items():
-                statement.add_where_clause(WhereClause(
-                    col.db_field_name,
-                    EqualsOperator(),
-                    col.to_database(getattr(update, name))
-                ))
-            params = statement.get_context()
-            statement = SimpleStatement(str(statement))
-            cqlengine.connection.get_session().execute(statement, params)
-            del update._dirties
-#            for delete in self.deletes:
-#                raise NotImplementedError
-        for callable, args, kwargs in self.call_after_save:
-            callable(*args, **kwargs)
-        self.call_after_save = []
+
+
+def _take_pending(instance):
+    """Take instance's unsaved changes off it.
+
+    Returns (created, dirties, ttl), or None if there are none.  The
+    dirties of a created counter row are its counter values, which are
+    written as increments.  The caller holds instance's lock, if any.
+
+    """
+    state = instance.__dict__
+    state.pop('_dependencies', None)
+    created = state.pop('_created', False)
+    dirties = state.pop('_dirties', None)
+    if not created and dirties is None:
+        return None
+    ttl = state.pop('_ttl', None)
+    model = instance.id_mapped_class
+    if created and model._has_counter:
+        dirties = {}
+        for name, col in model._columns.items():
+            if isinstance(col, columns.Counter):
+                dirties[name] = getattr(instance, name)
+    return created, dirties, ttl
+
+
+def _partition(instance):
+    """Return instance's partition key values, in database form."""
+    return tuple(col.to_database(getattr(instance, name))
+                 for name, col in instance.id_mapped_class._partition_keys.items())
+
+
+def _is_blind(instance):
+    """Return whether instance is a handle with nothing loaded or written."""
+    model = instance.id_mapped_class
+    return (len(instance._values) == len(model._primary_keys) and
+            len(model._columns) > len(model._primary_keys) and
+            not getattr(instance, '_created', False) and
+            not hasattr(instance, '_dirties'))
+
+
+def _database_key(instance):
+    """Return instance's primary key values, in database form."""
+    return tuple(col.to_database(getattr(instance, name))
+                 for name, col in instance.id_mapped_class._primary_keys.items())
+
+
+def _partition_of(instance):
+    """Return (column family name, partition key values) for instance."""
+    return (instance.id_mapped_class.column_family_name(), _partition(instance))
+
+
+_RANGE_OPERATORS = {
+    GreaterThanOperator: operator.gt,
+    GreaterThanOrEqualOperator: operator.ge,
+    LessThanOperator: operator.lt,
+    LessThanOrEqualOperator: operator.le,
+}
+
+
+def _matches(instance, where):
+    """Return whether instance's primary key satisfies the where clauses."""
+    model = instance.id_mapped_class
+    for clause in where:
+        name = model._db_map.get(clause.field, clause.field)
+        col = model._columns[name]
+        value = _sort_key(col.to_database(getattr(instance, name)))
+        op = type(clause.operator)
+        if op is EqualsOperator:
+            if value != _sort_key(clause.value):
+                return False
+        elif op is InOperator:
+            if value not in [_sort_key(v) for v in clause.value]:
+                return False
+        elif not _RANGE_OPERATORS[op](value, _sort_key(clause.value)):
+            return False
+    return True
+
+
+def _key_range(model, where):
+    """Return the slice of one partition the where clauses select, or None.
+
+    The slice is (partition, prefix, lower, upper): partition and prefix
+    hold the values of the partition keys and the sort keys of the first
+    clustering keys, and lower and upper are (sort key, inclusive) bounds on
+    the next clustering key, or None.
+
+    """
+    by_field = {}
+    for clause in where:
+        by_field.setdefault(clause.field, []).append(clause)
+    partition = []
+    for col in model._partition_keys.values():
+        clauses = by_field.pop(col.db_field_name, ())
+        if len(clauses) != 1 or type(clauses[0].operator) is not EqualsOperator:
+            return None
+        partition.append(clauses[0].value)
+    prefix = []
+    lower = None
+    upper = None
+    for col in model._clustering_keys.values():
+        clauses = by_field.pop(col.db_field_name, ())
+        if not clauses:
+            break
+        if len(clauses) == 1 and type(clauses[0].operator) is EqualsOperator:
+            prefix.append(_sort_key(clauses[0].value))
+            continue
+        for clause in clauses:
+            op = type(clause.operator)
+            bound = (_sort_key(clause.value),
+                     op in (GreaterThanOrEqualOperator, LessThanOrEqualOperator))
+            if op in (GreaterThanOperator, GreaterThanOrEqualOperator) and lower is None:
+                lower = bound
+            elif op in (LessThanOperator, LessThanOrEqualOperator) and upper is None:
+                upper = bound
+            else:
+                return None
+        break
+    if by_field:
+        # Restrictions on later clustering keys, or on other columns.
+        return None
+    try:
+        hash(tuple(partition))
+    except TypeError:
+        return None
+    return tuple(partition), tuple(prefix), lower, upper
+
+
+def _range_covers(loaded, wanted):
+    """Return whether the (prefix, lower, upper) slice loaded holds wanted."""
+    loaded_prefix, loaded_lower, loaded_upper = loaded
+    prefix, lower, upper = wanted
+    size = len(loaded_prefix)
+    if len(prefix) < size or prefix[:size] != loaded_prefix:
+        return False
+    if len(prefix) > size:
+        # wanted fixes the key that loaded has bounds on.
+        value = _sort_key(prefix[size])
+        return (_above(value, True, loaded_lower) and
+                _below(value, True, loaded_upper))
+    if loaded_lower is not None and (lower is None or
+                                     not _above(lower[0], lower[1], loaded_lower)):
+        return False
+    if loaded_upper is not None and (upper is None or
+                                     not _below(upper[0], upper[1], loaded_upper)):
+        return False
+    return True
+
+
+def _above(value, inclusive, bound):
+    """Return whether everything from value on is above the lower bound."""
+    if bound is None:
+        return True
+    bound_value, bound_inclusive = bound
+    return value > bound_value or (value == bound_value and
+                                   (bound_inclusive or not inclusive))
+
+
+def _below(value, inclusive, bound):
+    """Return whether everything up to value is below the upper bound."""
+    if bound is None:
+        return True
+    bound_value, bound_inclusive = bound
+    return value < bound_value or (value == bound_value and
+                                   (bound_inclusive or not inclusive))
+
+
+def _sort_key(value):
+    """Return a key that orders database values the way Cassandra does."""
+    if isinstance(value, UUID):
+        # Cassandra orders version 1 uuids by their time, not their bytes.
+        if value.version == 1:
+            return (1, value.time, value.bytes)
+        return (value.version, 0, value.bytes)
+    return value
+
+
+def _primary_key_where(instance):
+    """Return where clauses selecting instance's row."""
+    where = []
+    for name, col in instance.id_mapped_class._primary_keys.items():
+        where.append(WhereClause(
+            col.db_field_name,
+            EqualsOperator(),
+            col.to_database(getattr(instance, name))
+        ))
+    return where
+
+
+class SessionInsertStatement(InsertStatement):
+    """InsertStatement that can carry both a ttl and a timestamp.
+
+    cqlengine renders each of them as its own USING clause, which Cassandra
+    rejects when both are present.
+
+    """
+
+    def __unicode__(self):
+        qs = ['INSERT INTO {}'.format(self.table)]
+
+        # get column names and context placeholders
+        fields = [a.insert_tuple() for a in self.assignments]
+        columns, values = zip(*fields)
+
+        qs += ["({})".format(', '.join(['"{}"'.format(c) for c in columns]))]
+        qs += ['VALUES']
+        qs += ["({})".format(', '.join(['%({})s'.format(v) for v in values]))]
+
+        using_options = []
+        if self.ttl:
+            using_options += ["TTL {}".format(self.ttl)]
+        if self.timestamp:
+            using_options += ["TIMESTAMP {}".format(self.timestamp_normalized)]
+        if using_options:
+            qs += ["USING {}".format(" AND ".join(using_options))]
+
+        return ' '.join(qs)
+
+
+class QueryCache(object):
+    """The rows of recent queries, shared by every session.
+
+    use: set_query_cache(QueryCache(ttl=5))
+
+    Entries are keyed on the CQL text and parameters of the query.  They
+    expire after ttl seconds, and a save() writing to a table invalidates
+    the entries for that table.  Writes by other processes are only seen
+    once the entries expire.
+
+    """
+
+    def __init__(self, ttl=5.0, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # key -> (expiry time, table, generation, rows), oldest first
+        self._entries = OrderedDict()
+        # Table name -> times it has been invalidated.
+        self._generations = {}
+
+    def key(self, statement):
+        """Return the cache key for a SelectStatement, None if it has none."""
+        try:
+            key = (unicode(statement), _hashable(statement.get_context()))
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def generation(self, table):
+        return self._generations.get(table, 0)
+
+    def get(self, key):
+        """Return a copy of the rows cached for key, or None."""
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, table, generation, rows = entry
+            if expires < time.time() or generation != self._generations.get(table, 0):
+                del self._entries[key]
+                return None
+        # Copies, since result constructors may change the rows.
+        return [dict(row) for row in rows]
+
+    def put(self, key, table, generation, rows):
+        """Cache rows, read when table was at generation, and return them."""
+        rows = [dict(row) for row in rows]
+        if key is not None:
+            entry = (time.time() + self.ttl,
+                     table,
+                     generation,
+                     tuple(dict(row) for row in rows))
+            with self._lock:
+                self._entries.pop(key, None)
+                self._entries[key] = entry
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return rows
+
+    def invalidate(self, *tables):
+        """Forget the results of queries on tables."""
+        with self._lock:
+            for table in tables:
+                self._generations[table] = self._generations.get(table, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class PartitionCache(object):
+    """The first rows of recently read partitions, shared by every session.
+
+    use: set_partition_cache(PartitionCache(max_rows=100))
+
+    Reading the first N rows of a partition, a query with nothing but an
+    equality on each partition key, caches up to max_rows of them in
+    clustering order.  Later reads of no more rows than are cached are
+    answered from the cache.  Rows created through a session are merged in,
+    other writes through a session drop the partition, and writes by other
+    processes are only seen once the partition expires after ttl seconds.
+
+    """
+
+    def __init__(self, max_rows=100, max_partitions=10000, ttl=60.0):
+        self.max_rows = max_rows
+        self.max_partitions = max_partitions
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # (table, partition) -> [expiry time, complete, rows, clustering
+        # keys], least recently used first.  complete is True if rows is
+        # the whole partition.
+        self._entries = OrderedDict()
+        # Table name -> times its partitions have changed.
+        self._generations = {}
+
+    def generation(self, table):
+        return self._generations.get(table, 0)
+
+    def get(self, model, partition, limit):
+        """Return copies of the first limit rows of partition, or None."""
+        key = (model.column_family_name(), partition)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, complete, rows, keys = entry
+            if expires < time.time():
+                return None
+            self._entries[key] = entry
+            if not complete and (limit is None or limit > len(rows)):
+                return None
+            return [dict(row) for row in rows[:limit]]
+
+    def put(self, model, partition, generation, rows, complete):
+        """Cache the first rows of partition, read when its table was at
+        generation, and return copies of them."""
+        table = model.column_family_name()
+        cached = [dict(row) for row in rows[:self.max_rows]]
+        complete = complete and len(cached) == len(rows)
+        keys = [_clustering_key(model, row) for row in cached]
+        with self._lock:
+            if generation == self._generations.get(table, 0):
+                self._entries.pop((table, partition), None)
+                self._entries[(table, partition)] = [
+                        time.time() + self.ttl, complete, cached, keys]
+                while len(self._entries) > self.max_partitions:
+                    self._entries.popitem(last=False)
+        return [dict(row) for row in rows]
+
+    def apply(self, flush):
+        """Bring the cache up to date with a written Flush."""
+        merged = set(id(statement) for partition, statement, model, row in flush.rows)
+        with self._lock:
+            for partition, statement in flush.statements + flush.counter_statements:
+                self._generations[partition[0]] = self._generations.get(partition[0], 0) + 1
+                if id(statement) not in merged:
+                    self._entries.pop(partition, None)
+            for partition, statement, model, row in flush.rows:
+                entry = self._entries.get(partition)
+                if entry is not None:
+                    self._merge(entry, model, row)
+
+    def _merge(self, entry, model, row):
+        expires, complete, rows, keys = entry
+        key = _clustering_key(model, row)
+        descending = _descending(model)
+        for i, other in enumerate(keys):
+            order = _compare_clustering(key, other, descending)
+            if order == 0:
+                # Inserts overwrite only the columns they set.
+                rows[i] = dict(rows[i], **dict((k, v) for k, v in row.iteritems()
+                                                if v is not None))
+                return
+            if order < 0:
+                rows.insert(i, dict(row))
+                keys.insert(i, key)
+                break
+        else:
+            if not complete:
+                # Past the end of the cached rows.
+                return
+            rows.append(dict(row))
+            keys.append(key)
+        if len(rows) > self.max_rows:
+            del rows[self.max_rows:]
+            del keys[self.max_rows:]
+            entry[1] = False
+
+    def invalidate(self, table, partition):
+        """Forget the rows of partition."""
+        with self._lock:
+            self._generations[table] = self._generations.get(table, 0) + 1
+            self._entries.pop((table, partition), None)
+
+    def invalidate_tables(self, *tables):
+        """Forget the rows of every partition of tables."""
+        tables = set(tables)
+        with self._lock:
+            for table in tables:
+                self._generations[table] = self._generations.get(table, 0) + 1
+            for key in [key for key in self._entries if key[0] in tables]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _clustering_key(model, row):
+    """Return the sort keys of row's clustering key values."""
+    return tuple(_sort_key(col.to_database(col.to_python(row[col.db_field_name])))
+                 for col in model._clustering_keys.values())
+
+
+def _descending(model):
+    return [(col.clustering_order or '').lower() == 'desc'
+            for col in model._clustering_keys.values()]
+
+
+def _compare_clustering(key, other, descending):
+    """Return -1, 0 or 1 as key is before, at or after other in a partition."""
+    for value, other_value, desc in zip(key, other, descending):
+        if value != other_value:
+            return -1 if (value < other_value) != desc else 1
+    return 0
+
+
+class NegativeCache(object):
+    """Primary keys get() found missing, shared by every session.
+
+    use: set_negative_cache(NegativeCache(ttl=60))
+
+    Entries expire after ttl seconds.  Writes through a session remove the
+    keys they write, but rows created by other processes are only seen
+    once the entries expire.
+
+    """
+
+    def __init__(self, ttl=60.0, max_entries=100000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # (table, key) -> expiry time, oldest first
+        self._entries = OrderedDict()
+
+    def add(self, table, key):
+        with self._lock:
+            self._entries.pop((table, key), None)
+            self._entries[(table, key)] = time.time() + self.ttl
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def contains(self, table, key):
+        expires = self._entries.get((table, key))
+        if expires is None:
+            return False
+        if expires < time.time():
+            self.discard(table, key)
+            return False
+        return True
+
+    def discard(self, table, key):
+        with self._lock:
+            self._entries.pop((table, key), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class BloomNegativeCache(object):
+    """A NegativeCache in a fixed-size Bloom filter, for large key spaces.
+
+    use: set_negative_cache(BloomNegativeCache(capacity=10000000))
+
+    Beware: a Bloom filter has false positives.  About error_rate of the
+    keys never added test as missing anyway, once capacity keys have been
+    added, and get() then raises DoesNotExist for rows that may exist.
+    Only use it where that is acceptable.  Keys written through a session
+    after being added are kept in an exact set, so they are never reported
+    missing.  Entries do not expire; call clear().
+
+    """
+
+    def __init__(self, capacity=1000000, error_rate=0.001):
+        bit_count = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self._bit_count = bit_count
+        self._hash_count = max(1, int(round(bit_count / float(capacity) * math.log(2))))
+        self._lock = threading.Lock()
+        self._bits = bytearray((bit_count + 7) // 8)
+        # (table, key) that tested as missing when written.
+        self._written = set()
+
+    def _positions(self, table, key):
+        digest = hashlib.md5(repr((table, key))).digest()
+        first, second = struct.unpack('>QQ', digest)
+        return [(first + i * second) % self._bit_count
+                for i in xrange(self._hash_count)]
+
+    def add(self, table, key):
+        with self._lock:
+            for position in self._positions(table, key):
+                self._bits[position >> 3] |= 1 << (position & 7)
+            self._written.discard((table, key))
+
+    def contains(self, table, key):
+        bits = self._bits
+        for position in self._positions(table, key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return (table, key) not in self._written
+
+    def discard(self, table, key):
+        if self.contains(table, key):
+            with self._lock:
+                self._written.add((table, key))
+
+    def clear(self):
+        with self._lock:
+            self._bits = bytearray(len(self._bits))
+            self._written.clear()
+
+
+def _hashable(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _hashable(v)) for k, v in value.iteritems()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(value)
+    return value
+
+
+class BulkLoader(object):
+    """Stream creates to Cassandra without keeping the instances.
+
+    use:
+    with BulkLoader() as loader:
+        for row in rows:
+            loader.create(Foo, **row)
+    print loader.result
+
+    create() validates and encodes the row right away, and no instance is
+    made or registered in the session, so memory use stays the same however
+    many rows are loaded.  Rows are buffered, then written as one unlogged
+    batch per partition with at most concurrency requests in flight.  Write
+    errors are counted in the result rather than raised.
+
+    """
+
+    def __init__(self, concurrency=16, batch_size=100, buffer_size=5000,
+                 ttl=None, validation=VALIDATE_ALL, validate_sample=0.0):
+        """
+        concurrency -- most requests in flight at once
+        batch_size -- most rows in one batch
+        buffer_size -- rows held before sending them
+        ttl -- seconds until the rows expire, instead of __default_ttl__
+        validation, validate_sample -- as for Session
+        """
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.ttl = ttl
+        _check_validation(validation)
+        self.validation = validation
+        self.validate_sample = validate_sample
+        self.result = BulkLoadResult()
+        # (column plan, partition) -> [(query, params)]
+        self._buffer = OrderedDict()
+        self._buffered = 0
+        self._slots = threading.Semaphore(concurrency)
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._tables = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def create(self, model, **kwargs):
+        """Queue a row of model, defaulted like model.create(**kwargs)."""
+        plan = _column_plan(model)
+        query, params, partition = plan.encode(
+                model._create_values(kwargs),
+                _row_validation(self.validation, self.validate_sample))
+        group_key = (plan, partition)
+        try:
+            self._buffer[group_key].append((query, params))
+        except KeyError:
+            self._buffer[group_key] = [(query, params)]
+        self._buffered += 1
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Send the buffered rows."""
+        buffer = self._buffer
+        self._buffer = OrderedDict()
+        self._buffered = 0
+        timestamp = _client_timestamp()
+        session = cqlengine.connection.get_session()
+        for (plan, partition), rows in buffer.iteritems():
+            self._tables.add(plan.column_family_name)
+            ttl = self.ttl if self.ttl is not None else plan.ttl
+            if ttl:
+                using = ' USING TTL {} AND TIMESTAMP {}'.format(ttl, timestamp)
+            else:
+                using = ' USING TIMESTAMP {}'.format(timestamp)
+            for start in xrange(0, len(rows), self.batch_size):
+                self._send(session, rows[start:start + self.batch_size], using)
+
+    def close(self):
+        """Send the buffered rows, wait for every write, return the result."""
+        self.flush()
+        # Every slot free means nothing is in flight.
+        for i in xrange(self.concurrency):
+            self._slots.acquire()
+        for i in xrange(self.concurrency):
+            self._slots.release()
+        if QUERY_CACHE is not None:
+            QUERY_CACHE.invalidate(*self._tables)
+        if PARTITION_CACHE is not None:
+            PARTITION_CACHE.invalidate_tables(*self._tables)
+        self.result.elapsed = time.time() - self._started
+        return self.result
+
+    def _send(self, session, rows, using):
+        if len(rows) == 1:
+            query, params = rows[0]
+            query += using
+        else:
+            lines = ['BEGIN UNLOGGED BATCH']
+            params = []
+            for row_query, row_params in rows:
+                lines.append('  ' + row_query + using)
+                params.extend(row_params)
+            lines.append('APPLY BATCH;')
+            query = '\n'.join(lines)
+        statement = SimpleStatement(
+                query,
+                consistency_level=cqlengine.connection.default_consistency_level)
+        self._slots.acquire()
+        try:
+            future = session.execute_async(statement, params)
+        except Exception, e:
+            self._failed(e, len(rows))
+            return
+        future.add_callbacks(self._written, self._failed,
+                             callback_args=(len(rows),),
+                             errback_args=(len(rows),))
+
+    def _written(self, response, row_count):
+        with self._lock:
+            self.result.rows += row_count
+            self.result.batches += 1
+        self._slots.release()
+
+    def _failed(self, error, row_count):
+        with self._lock:
+            self.result.failed_rows += row_count
+            self.result.errors += 1
+            if len(self.result.error_samples) < self.result.max_error_samples:
+                self.result.error_samples.append(error)
+        self._slots.release()
+
+
+class BulkLoadResult(object):
+    """Counts kept by a BulkLoader."""
+
+    max_error_samples = 10
+
+    def __init__(self):
+        self.rows = 0
+        self.batches = 0
+        self.failed_rows = 0
+        # Rows bulk_import() could not validate.
+        self.invalid_rows = 0
+        self.errors = 0
+        # The first few write errors.
+        self.error_samples = []
+        self.elapsed = 0.0
+
+    @property
+    def rate(self):
+        """Rows written per second."""
+        if not self.elapsed:
+            return 0.0
+        return self.rows / self.elapsed
+
+    def __repr__(self):
+        return '<BulkLoadResult rows={} batches={} errors={} elapsed={:.2f}s rate={:.0f}/s>'.format(
+                self.rows, self.batches, self.errors, self.elapsed, self.rate)
+
+
+def bulk_import(model, rows, hosts, keyspace, processes=None,
+                chunk_size=1000, progress=None, **loader_options):
+    """Load rows of model with a BulkLoader in each of several processes.
+
+    rows -- iterable of dicts of create() keyword arguments
+    hosts, keyspace -- what each process passes to cqlengine's setup()
+    processes -- number of worker processes, default one per core
+    chunk_size -- rows sent to a worker at once
+    progress -- optional callable, given the number of rows handled so far
+    loader_options -- passed on to each BulkLoader
+
+    Rows are sharded by a hash of their partition key, so each partition is
+    loaded by one worker and still batched together.  Rows that fail to
+    validate are counted as invalid_rows rather than raised.  Returns a
+    BulkLoadResult totalling the workers' results, with error_samples as
+    strings.  Raises RuntimeError if a worker dies.
+
+    """
+    return _BulkImport(model, hosts, keyspace, processes or multiprocessing.cpu_count(),
+                       chunk_size, progress, loader_options).run(rows)
+
+
+class _BulkImport(object):
+
+    def __init__(self, model, hosts, keyspace, processes, chunk_size,
+                 progress, loader_options):
+        self.model = model
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.result = BulkLoadResult()
+        self.handled = 0
+        self.finished = set()
+        self.reports = multiprocessing.Queue()
+        self.inputs = []
+        self.workers = []
+        for worker_id in xrange(processes):
+            # Bounded, so reading rows keeps pace with loading them.
+            inputs = multiprocessing.Queue(maxsize=4)
+            worker = multiprocessing.Process(
+                    target=_bulk_import_worker,
+                    args=(worker_id, model, hosts, keyspace, inputs,
+                          self.reports, loader_options))
+            worker.daemon = True
+            worker.start()
+            self.inputs.append(inputs)
+            self.workers.append(worker)
+
+    def run(self, rows):
+        started = time.time()
+        partition_keys = self.model.id_mapped_class._partition_keys.items()
+        chunks = [[] for worker in self.workers]
+        try:
+            for row in rows:
+                try:
+                    values = self.model._create_values(row)
+                    partition = tuple(col.to_database(values[name])
+                                      for name, col in partition_keys)
+                except (ValidationError, ValueError), e:
+                    self._invalid(unicode(e))
+                    continue
+                worker_id = hash(partition) % len(self.workers)
+                chunk = chunks[worker_id]
+                chunk.append(values)
+                if len(chunk) >= self.chunk_size:
+                    self._put(worker_id, chunk)
+                    chunks[worker_id] = []
+            for worker_id, chunk in enumerate(chunks):
+                if chunk:
+                    self._put(worker_id, chunk)
+                self._put(worker_id, None)
+            while len(self.finished) < len(self.workers):
+                self._read_reports(timeout=1)
+        finally:
+            for worker in self.workers:
+                if worker.is_alive() and len(self.finished) < len(self.workers):
+                    worker.terminate()
+                worker.join()
+        self.result.elapsed = time.time() - started
+        return self.result
+
+    def _put(self, worker_id, chunk):
+        while True:
+            try:
+                self.inputs[worker_id].put(chunk, timeout=0.1)
+                break
+            except Queue.Full:
+                self._read_reports()
+        self._read_reports()
+
+    def _read_reports(self, timeout=None):
+        """Handle the workers' reports, waiting up to timeout for one."""
+        self._drain_reports(timeout)
+        exited = [worker_id for worker_id, worker in enumerate(self.workers)
+                  if worker_id not in self.finished and not worker.is_alive()]
+        if exited:
+            # A worker may have reported 'done' and exited after the queue
+            # was read.
+            self._drain_reports(0.1)
+            for worker_id in exited:
+                if worker_id not in self.finished:
+                    raise RuntimeError('Bulk import worker {} exited with {}'.format(
+                            worker_id, self.workers[worker_id].exitcode))
+
+    def _drain_reports(self, timeout):
+        """Handle the reports in the queue, waiting up to timeout for one."""
+        while True:
+            try:
+                if timeout is None:
+                    report = self.reports.get_nowait()
+                else:
+                    report = self.reports.get(timeout=timeout)
+                    timeout = None
+            except Queue.Empty:
+                break
+            kind, worker_id, value = report
+            if kind == 'progress':
+                self.handled += value
+                if self.progress is not None:
+                    self.progress(self.handled)
+            elif kind == 'invalid':
+                self._invalid(value)
+            elif kind == 'done':
+                self.finished.add(worker_id)
+                result = self.result
+                result.rows += value['rows']
+                result.batches += value['batches']
+                result.failed_rows += value['failed_rows']
+                result.errors += value['errors']
+                for sample in value['error_samples']:
+                    if len(result.error_samples) < result.max_error_samples:
+                        result.error_samples.append(sample)
+            elif kind == 'failed':
+                raise RuntimeError(
+                        'Bulk import worker {} failed:\n{}'.format(worker_id, value))
+
+    def _invalid(self, message):
+        self.result.invalid_rows += 1
+        if len(self.result.error_samples) < self.result.max_error_samples:
+            self.result.error_samples.append(message)
+
+
+def _bulk_import_worker(worker_id, model, hosts, keyspace, inputs, reports,
+                        loader_options):
+    try:
+        cqlengine.connection.setup(hosts, default_keyspace=keyspace)
+        loader = BulkLoader(**loader_options)
+        while True:
+            chunk = inputs.get()
+            if chunk is None:
+                break
+            for values in chunk:
+                try:
+                    loader.create(model, **values)
+                except ValidationError, e:
+                    reports.put(('invalid', worker_id, unicode(e)))
+            reports.put(('progress', worker_id, len(chunk)))
+        result = loader.close()
+        reports.put(('done', worker_id, {
+            'rows': result.rows,
+            'batches': result.batches,
+            'failed_rows': result.failed_rows,
+            'errors': result.errors,
+            'error_samples': [repr(e) for e in result.error_samples]}))
+    except Exception:
+        reports.put(('failed', worker_id, traceback.format_exc()))
+
+
+_COLUMN_PLANS = {}
+
+
+def _column_plan(model):
+    try:
+        return _COLUMN_PLANS[model]
+    except KeyError:
+        plan = _COLUMN_PLANS[model] = _ColumnPlan(model)
+        return plan
+
+
+class _ColumnPlan(object):
+    """How to validate and encode a row of a model, worked out once."""
+
+    def __init__(self, model):
+        mapped_class = model.id_mapped_class
+        if mapped_class._has_counter:
+            raise ValueError('Cannot bulk load counter model {}'.format(
+                    model.__name__))
+        self.column_family_name = mapped_class.column_family_name()
+        self.ttl = model.__default_ttl__
+        # (name, column, is partition key)
+        self.columns = [(name, col, name in mapped_class._partition_keys)
+                        for name, col in mapped_class._columns.items()]
+        # Insert query by the indexes of the columns that are not null.
+        self._queries = {}
+
+    def encode(self, values, validation=VALIDATE_ALL):
+        """Return (insert query, params, partition) for values by name."""
+        present = []
+        params = []
+        partition = []
+        for index, (name, col, is_partition_key) in enumerate(self.columns):
+            value = values[name]
+            if validation == VALIDATE_ALL:
+                value = col.validate(value)
+            elif validation == VALIDATE_KEYS:
+                _check_not_null(col, value)
+            if col._val_is_null(value):
+                continue
+            value = col.to_database(value)
+            present.append(index)
+            params.append(value)
+            if is_partition_key:
+                partition.append(value)
+        present = tuple(present)
+        try:
+            query = self._queries[present]
+        except KeyError:
+            query = self._queries[present] = 'INSERT INTO {} ({}) VALUES ({})'.format(
+                    self.column_family_name,
+                    ', '.join('"{}"'.format(self.columns[i][1].db_field_name)
+                              for i in present),
+                    ', '.join(['%s'] * len(present)))
+        return query, params, tuple(partition)
+
+
+class Journal(object):
+    """Append-only file recording a session's unsaved changes.
+
+    Each create, dirty mark, counter increment, ttl() override and delete
+    is appended as a length and checksum prefixed pickle, and the file is emptied by a
+    successful save.  After a crash, replay_journal() saves what was lost.
+
+    """
+
+    CREATE = 1
+    DIRTY = 2
+    INCREMENT = 3
+    DELETE = 4
+    DELETE_RANGE = 5
+    TTL = 6
+
+    _header = struct.Struct('>BII')
+
+    def __init__(self, path, sync=False):
+        """
+        path -- file to append to
+        sync -- if True, fsync after every record instead of only flushing
+                to the operating system
+        """
+        self.path = path
+        self.sync = sync
+        self._file = open(path, 'ab')
+
+    def _append(self, op, model_class, key, name, value):
+        payload = cPickle.dumps(
+                (model_class.id_mapped_class.column_family_name(), key, name, value),
+                cPickle.HIGHEST_PROTOCOL)
+        self._file.write(self._header.pack(op,
+                                           len(payload),
+                                           zlib.crc32(payload) & 0xffffffff))
+        self._file.write(payload)
+        self._file.flush()
+        if self.sync:
+            os.fsync(self._file.fileno())
+
+    def record_create(self, instance):
+        values = dict((name, _plain(value))
+                      for name, value in instance._values.iteritems())
+        self._append(self.CREATE, instance.__class__, instance.key, None, values)
+
+    def record_dirty(self, instance, name, value):
+        self._append(self.DIRTY, instance.__class__, instance.key, name, _plain(value))
+
+    def record_increment(self, instance, name, value):
+        self._append(self.INCREMENT, instance.__class__, instance.key, name, value)
+
+    def record_ttl(self, instance, ttl):
+        self._append(self.TTL, instance.__class__, instance.key, None, ttl)
+
+    def record_delete(self, instance):
+        self._append(self.DELETE, instance.__class__, instance.key, None, None)
+
+    def record_delete_range(self, model_class, kwargs):
+        self._append(self.DELETE_RANGE, model_class, None, None, kwargs)
+
+    def truncate(self):
+        self._file.seek(0)
+        self._file.truncate()
+
+    def rewrite(self, session):
+        """Replace the journal's contents with session's pending changes."""
+        self.truncate()
+        # Deletes go first: a row created after its delete was queued is
+        # still in the identity map, and must be replayed after the delete.
+        for model_class, partition, where, instance, kwargs in session.deletes:
+            if instance is not None:
+                self.record_delete(instance)
+            else:
+                self.record_delete_range(model_class, kwargs)
+        for model_class, by_key in session.instances_by_class.iteritems():
+            for instance in by_key.itervalues():
+                if getattr(instance, '_created', False):
+                    self.record_create(instance)
+                    if instance._ttl is not None:
+                        self.record_ttl(instance, instance._ttl)
+                    continue
+                dirties = getattr(instance, '_dirties', None)
+                if not dirties:
+                    continue
+                if instance._ttl is not None:
+                    self.record_ttl(instance, instance._ttl)
+                for name, value in dirties.iteritems():
+                    if model_class.id_mapped_class._has_counter:
+                        self.record_increment(instance, name, value)
+                    else:
+                        self.record_dirty(instance, name, value)
+
+    def close(self):
+        self._file.close()
+
+    @classmethod
+    def read(cls, path):
+        """Yield (op, column family name, key, name, value) for each record.
+
+        Reading stops quietly at a record that was only partly written.
+
+        """
+        with open(path, 'rb') as journal_file:
+            while True:
+                header = journal_file.read(cls._header.size)
+                if len(header) < cls._header.size:
+                    return
+                op, length, checksum = cls._header.unpack(header)
+                payload = journal_file.read(length)
+                if len(payload) < length or zlib.crc32(payload) & 0xffffffff != checksum:
+                    return
+                yield (op,) + cPickle.loads(payload)
+
+
+def replay_journal(path, *models):
+    """Save the changes recorded in the journal at path, then empty it.
+
+    models -- the SessionModel classes the journal may refer to
+
+    Returns the number of records replayed.
+
+    """
+    by_cf = dict((model.id_mapped_class.column_family_name(), model)
+                 for model in models)
+    previous = SESSION_MANAGER.get_session()
+    session = Session()
+    SESSION_MANAGER.set_session(session)
+    count = 0
+    try:
+        for op, cf_name, key, name, value in Journal.read(path):
+            try:
+                model = by_cf[cf_name]
+            except KeyError:
+                raise ValueError(u'Journal refers to {}, which is not among the given models'.format(cf_name))
+            if op == Journal.CREATE:
+                model.create(**value)
+            elif op == Journal.DIRTY:
+                setattr(model(*key), name, value)
+            elif op == Journal.INCREMENT:
+                model(*key).blind_increment(name, value)
+            elif op == Journal.TTL:
+                model(*key).ttl(value)
+            elif op == Journal.DELETE:
+                session.delete(model(*key))
+            elif op == Journal.DELETE_RANGE:
+                session.delete_range(model, **value)
+            else:
+                raise ValueError(u'Unknown journal record type {}'.format(op))
+            count += 1
+        session.save()
+    finally:
+        SESSION_MANAGER.set_session(previous)
+    open(path, 'wb').close()
+    return count
+
+
+def _plain(value):
+    """Return value without the Owned container wrapper, if it has one."""
+    if isinstance(value, OwnedSet):
+        return set(value)
+    if isinstance(value, OwnedList):
+        return list(value)
+    if isinstance(value, OwnedMap):
+        return dict(value)
+    return value
 
 
 class SessionModelMetaClass(ModelMetaClass):
@@ -224,6 +2277,24 @@ class SessionModelMetaClass(ModelMetaClass):
                                                              attrs)
         if len(bases) > 1:
             raise TypeError('SessionModel does not allow multiple inheritance')
+        lazy = attrs.get('__lazy__')
+        if lazy is None:
+            lazy = getattr(bases[0], '__lazy__', None)
+        if lazy is None:
+            lazy = LAZY_MODELS
+        if lazy:
+            # Built by _build_lazy_model() on first use.
+            return LazyIdMapMetaClass(name, (IdMapModel,), {
+                '__module__': attrs['__module__'],
+                '__doc__': attrs.get('__doc__'),
+                '_lazy_definition': (cls, name, bases, attrs),
+            })
+        return IdMapMetaClass(name, (IdMapModel,), cls._session_attrs(name, bases, attrs))
+
+    @classmethod
+    def _session_attrs(cls, name, bases, attrs):
+        """Make the cqlengine model for a SessionModel declaration, and return
+        the attributes of the session class."""
         # Take the result of the base class's __new__ and assign it to the
         # module using a prefixed underscore in the name.
         new_name = '_' + name
@@ -235,30 +2306,90 @@ class SessionModelMetaClass(ModelMetaClass):
                                                          attrs)
         # Note: at this point, attrs has had a bunch of things added by
         # cqlengine.models.ModelMetaClass
-        module = importlib.import_module(cls.__module__)
+        # The declaring module is being imported, so it is already in
+        # sys.modules.
+        module = sys.modules[attrs['__module__']]
         setattr(module, new_name, base)
 
         # Copy attrs from the base class because this class won't actually
         # inherit from these base classes.
-        base_attrs = {}
-        copyable_bases = []
-        for klass in bases[0].mro():
-            if klass == SessionModel:
-                break
-            copyable_bases.append(klass)
-        for klass in reversed(copyable_bases):
-            base_attrs.update(klass.__dict__)
+        base_attrs = dict(_base_attrs(bases[0]))
         base_attrs.update(attrs)
         base_attrs['id_mapped_class'] = base
-        base_attrs['_promotable_column_names'] = set([cname for cname, c in base_attrs['_columns'].iteritems() if not c.primary_key])
         # Make descriptors for the columns so the instances will get/set
         # using a ColumnDescriptor instance.
         for col_name, col in base._columns.iteritems():
             if isinstance(col, columns.Counter):
                 base_attrs[col_name] = CounterColumnDescriptor(col)
+            elif isinstance(col, columns.BaseContainerColumn):
+                base_attrs[col_name] = ContainerColumnDescriptor(col)
             else:
                 base_attrs[col_name] = ColumnDescriptor(col)
-        return IdMapMetaClass(name, (IdMapModel,), base_attrs)
+        return base_attrs
+
+
+# If True, SessionModels declared without __lazy__ are lazy, see
+# set_lazy_models().
+LAZY_MODELS = False
+
+
+def set_lazy_models(lazy=True):
+    """Make SessionModels declared from now on build on first use.
+
+    A lazy model's cqlengine model, column descriptors and the rest are
+    made the first time the class is used, rather than when it is
+    declared, so that importing models that are never used is cheap.  A
+    model can also choose with a __lazy__ class attribute, which its
+    subclasses inherit.
+
+    """
+    global LAZY_MODELS
+    LAZY_MODELS = lazy
+
+
+# Attributes of a lazy model that don't build it.
+_LAZY_ATTRIBUTES = frozenset(['__name__', '__module__', '__doc__', '__class__',
+                              '__dict__', '__mro__', '__bases__',
+                              '_lazy_definition'])
+
+_LAZY_LOCK = threading.RLock()
+
+
+def _build_lazy_model(cls):
+    """Build a lazy model declared by SessionModelMetaClass."""
+    with _LAZY_LOCK:
+        if type(cls) is not LazyIdMapMetaClass:
+            # Built by another thread meanwhile.
+            return
+        metaclass, name, bases, attrs = type.__getattribute__(cls, '_lazy_definition')
+        for key, value in metaclass._session_attrs(name, bases, attrs).iteritems():
+            if key not in ('__dict__', '__weakref__', '__doc__', '__module__'):
+                setattr(cls, key, value)
+        # From here on, attributes are looked up as usual.
+        type.__setattr__(cls, '__class__', IdMapMetaClass)
+        delattr(cls, '_lazy_definition')
+
+
+# Base class -> the attributes it and its bases up to SessionModel declare,
+# shared by the models declared on it.
+_BASE_ATTRS = {}
+
+
+def _base_attrs(base):
+    try:
+        return _BASE_ATTRS[base]
+    except KeyError:
+        pass
+    base_attrs = {}
+    copyable_bases = []
+    for klass in base.mro():
+        if klass == SessionModel:
+            break
+        copyable_bases.append(klass)
+    for klass in reversed(copyable_bases):
+        base_attrs.update(klass.__dict__)
+    _BASE_ATTRS[base] = base_attrs
+    return base_attrs
 
 
 # declare your models with this so that SessionModelMetaClass is the metaclass.
@@ -275,6 +2406,8 @@ class IdMapMetaClass(type):
     def __call__(cls, *key):
         """If instance is in the id-map, return it, else make and return it."""
         session = get_session()
+        if session.locks is not None:
+            return session._locked_instance(cls, key)
         try:
             instance_by_key = session.instances_by_class[cls]
             try:
@@ -289,6 +2422,25 @@ class IdMapMetaClass(type):
         return instance
 
 
+class LazyIdMapMetaClass(IdMapMetaClass):
+    """The metaclass of a lazy SessionModel until its first use.
+
+    Using the class, other than its name and module, builds it and makes
+    IdMapMetaClass its metaclass.
+
+    """
+
+    def __getattribute__(cls, name):
+        if name in _LAZY_ATTRIBUTES:
+            return type.__getattribute__(cls, name)
+        _build_lazy_model(cls)
+        return getattr(cls, name)
+
+    def __call__(cls, *key):
+        _build_lazy_model(cls)
+        return cls(*key)
+
+
 # this is copied from cqlengine, may need more modification..
 class QuerySetDescriptor(object):
     def __get__(self, instance, session_class):
@@ -301,6 +2453,18 @@ class IdMapModel(object):
 
     objects = QuerySetDescriptor()
 
+    # Seconds until values written for this model expire, or None.
+    __default_ttl__ = None
+
+    _ttl = None
+
+    # True if the instance was loaded with only() or defer() and some
+    # columns are still missing.
+    _partial = False
+
+    # The lock guarding the instance's changes, in a ConcurrentSession.
+    _lock = None
+
     def __init__(self, *key):
         self.key = key
         key_names = self.id_mapped_class._primary_keys.keys()
@@ -312,15 +2476,52 @@ class IdMapModel(object):
         return cls.objects.all()
 
     @classmethod
-    def filter(cls, *args, **kwargs):
-        return cls.objects.filter(*args, **kwargs)
+    def filter(cls, *args, **kwargs):
+        return cls.objects.filter(*args, **kwargs)
+
+    @classmethod
+    def get(cls, *args, **kwargs):
+        return cls.objects.get(*args, **kwargs)
+
+    @classmethod
+    def create(cls, **kwargs):
+        primary_keys = cls.id_mapped_class._primary_keys
+        uncleaned_values = cls._create_values(kwargs)
+        key = []
+        for name, col in primary_keys.items():
+            key.append(col.to_python(uncleaned_values[name]))
+        instance = cls(*key)
+        session = get_session()
+        if session.missing or NEGATIVE_CACHE is not None:
+            session.forget_missing(instance)
+        with instance._lock or _NO_LOCK:
+            instance._created = True
+            for name, col in cls.id_mapped_class._columns.items():
+                if name in primary_keys:
+                    continue
+                value = uncleaned_values[name]
+                if isinstance(col, columns.BaseContainerColumn):
+                    if isinstance(col, columns.Set):
+                        value = OwnedSet(instance, name, col.to_python(value))
+                    elif isinstance(col, columns.List):
+                        value = OwnedList(instance, name, col.to_python(value))
+                    elif isinstance(col, columns.Map):
+                        value = OwnedMap(instance, name, col.to_python(value))
+                elif value is not None:
+                    value = col.to_python(value)
+                instance._promote(name, value)
+        journal = _journal()
+        if journal is not None:
+            journal.record_create(instance)
+        return instance
+
+    @classmethod
+    def _create_values(cls, kwargs):
+        """Return the values create() gives a new row, by column name.
 
-    @classmethod
-    def get(cls, *args, **kwargs):
-        return cls.objects.get(*args, **kwargs)
+        Columns missing from kwargs get their default.
 
-    @classmethod
-    def create(cls, **kwargs):
+        """
         column_names = cls.id_mapped_class._columns.keys()
         extra_columns = set(kwargs.keys()) - set(column_names)
         if extra_columns:
@@ -346,27 +2547,26 @@ class IdMapModel(object):
                     # Container columns have non-None empty cases.
                     value = None
             uncleaned_values[name] = value
+        return uncleaned_values
 
-        key = []
-        for name, col in primary_keys.items():
-            key.append(col.to_python(uncleaned_values[name]))
-        instance = cls(*key)
-        instance._created = True
-        for name, col in cls.id_mapped_class._columns.items():
-            if name in primary_keys:
-                continue
-            value = uncleaned_values[name]
-            if isinstance(col, columns.BaseContainerColumn):
-                if isinstance(col, columns.Set):
-                    value = OwnedSet(instance, name, col.to_python(value))
-                elif isinstance(col, columns.List):
-                    value = OwnedList(instance, name, col.to_python(value))
-                elif isinstance(col, columns.Map):
-                    value = OwnedMap(instance, name, col.to_python(value))
-            elif value is not None:
-                value = col.to_python(value)
-            instance._promote(name, value)
-        return instance
+    def ttl(self, ttl):
+        """Expire the values written by the next save after ttl seconds.
+
+        Overrides the model's __default_ttl__ for this instance only.
+
+        """
+        self._ttl = ttl
+        journal = _journal()
+        if journal is not None:
+            journal.record_ttl(self, ttl)
+        return self
+
+    def _get_ttl(self, ttl):
+        """Return the ttl to write with, given the _ttl a flush took off
+        this instance."""
+        if ttl is not None:
+            return ttl
+        return self.__default_ttl__
 
     def promote(self, **kwargs):
         """Set kwargs on entity without marking as dirty
@@ -376,7 +2576,14 @@ class IdMapModel(object):
         Promoting the value of a key raises an exception
 
         """
-        extra_columns = set(kwargs.keys()) - self._promotable_column_names
+        cls = type(self)
+        promotable = cls.__dict__.get('_promotable_column_names')
+        if promotable is None:
+            # Worked out on first use, to keep class creation cheap.
+            promotable = set(name for name, col in cls._columns.iteritems()
+                             if not col.primary_key)
+            cls._promotable_column_names = promotable
+        extra_columns = set(kwargs.keys()) - promotable
         if extra_columns:
             raise ValidationError("Incorrect columns passed: {}".format(extra_columns))
 
@@ -390,52 +2597,132 @@ class IdMapModel(object):
         except AttributeError:
             self._values = {name: value}
 
-    def _mark_dirty(self, name, value):
-        """mark an attribute as dirty."""
+    def loaded_columns(self):
+        """Return the names of the columns this instance holds values for."""
+        try:
+            return frozenset(self._values)
+        except AttributeError:
+            return frozenset()
+
+    def depends_on(self, *instances):
+        """Save instances along with this one in save(self, dependencies=True).
+
+        The dependencies are forgotten once this instance is saved.
+
+        """
         try:
-            self._dirties[name] = value
+            self._dependencies.extend(instances)
         except AttributeError:
-            self._dirties = {name: value}
+            self._dependencies = list(instances)
+
+    def delete(self):
+        """Delete this instance's row at the next save."""
+        get_session().delete(self)
+
+    def _mark_dirty(self, name, value):
+        """mark an attribute as dirty."""
+        lock = self._lock
+        if lock is None:
+            try:
+                self._dirties[name] = value
+            except AttributeError:
+                self._dirties = {name: value}
+        else:
+            with lock:
+                try:
+                    self._dirties[name] = value
+                except AttributeError:
+                    self._dirties = {name: value}
+        journal = _journal()
+        if journal is not None:
+            journal.record_dirty(self, name, value)
 
     @classmethod
     def sync_table(cls):
         sync_table(cls.id_mapped_class)
 
     @classmethod
-    def _construct_instance(cls, values):
-        mapped_class = cls.id_mapped_class
-        primary_keys = mapped_class._primary_keys
-        key = []
-        for name, col in primary_keys.items():
-            key.append(col.to_python(values[name]))
-        instance = cls(*key)
-        cleaned_values = {}
-        for name, value in values.items():
-            if name in primary_keys:
-                continue
-            # Ignore results for columns returned that are not in the schema.
-            # (They may be present as a result of migrating an existing db.)
-            col = cls.id_mapped_class._columns.get(name)
-            if col:
-                if isinstance(col, columns.BaseContainerColumn):
-                    if isinstance(col, columns.Set):
-                        value = OwnedSet(instance, name, col.to_python(value))
-                    elif isinstance(col, columns.List):
-                        value = OwnedList(instance, name, col.to_python(value))
-                    elif isinstance(col, columns.Map):
-                        value = OwnedMap(instance, name, col.to_python(value))
-                elif value is not None:
+    def _row_plan(cls):
+        """Return the primary key's (name, column) pairs and a dict of the
+        other columns' names to (column, convert), worked out on first use.
+
+        convert is False for containers, which are kept as the driver
+        returned them until ContainerColumnDescriptor wraps them on first
+        access.
+
+        """
+        plan = cls.__dict__.get('_row_plan_cache')
+        if plan is None:
+            mapped_class = cls.id_mapped_class
+            primary_keys = mapped_class._primary_keys
+            value_columns = {}
+            for name, col in mapped_class._columns.iteritems():
+                if name not in primary_keys:
+                    value_columns[name] = (
+                        col, not isinstance(col, columns.BaseContainerColumn))
+            plan = (tuple(primary_keys.iteritems()), value_columns)
+            cls._row_plan_cache = plan
+        return plan
+
+    @classmethod
+    def _construct_instance(cls, values, partial=False):
+        """Return the instance for a row, with the row's values merged in.
+
+        partial -- True if the row has only some of the columns
+
+        Dirty values are kept over the row's.
+
+        """
+        key_columns, value_columns = cls._row_plan()
+        if len(key_columns) == 1:
+            name, col = key_columns[0]
+            instance = cls(col.to_python(values[name]))
+        else:
+            instance = cls(*[col.to_python(values[name])
+                             for name, col in key_columns])
+        # The key was promoted by __init__, so _values exists.
+        instance_values = instance._values
+        with instance._lock or _NO_LOCK:
+            try:
+                dirties = instance._dirties
+            except AttributeError:
+                dirties = EMPTY
+            for name, value in values.iteritems():
+                try:
+                    col, convert = value_columns[name]
+                except KeyError:
+                    # A primary key, or a column returned that is not in the
+                    # schema.  (It may be present as a result of migrating an
+                    # existing db.)
+                    continue
+                if name in dirties:
+                    continue
+                if convert and value is not None:
                     value = col.to_python(value)
-                cleaned_values[name] = value
-        try:
-            dirties = instance._dirties
-        except AttributeError:
-            dirties = EMPTY
-        for name, value in cleaned_values.items():
-            if name not in primary_keys and name not in dirties:
-                instance._promote(name, value)
+                instance_values[name] = value
+        if partial:
+            instance._partial = len(instance_values) < len(cls.id_mapped_class._columns)
+        elif instance._partial:
+            instance._partial = False
         return instance
 
+    @classmethod
+    def _cached_instance(cls, values, partial=False):
+        """Return the instance for a row from the QueryCache.
+
+        An instance already in the identity map is returned as it is, since
+        it is at least as recent as the cached row.
+
+        """
+        by_key = get_session().instances_by_class.get(cls)
+        if by_key is not None:
+            key = tuple([col.to_python(values[name])
+                         for name, col in cls._row_plan()[0]])
+            instance = by_key.get(key)
+            if instance is not None and instance._values.viewkeys() >= values.viewkeys():
+                return instance
+        return cls._construct_instance(values, partial)
+
     @property
     def _key(self):
         return getattr(self, self._key_name)
@@ -444,30 +2731,17 @@ class IdMapModel(object):
         col = self.id_mapped_class._columns[name]
         if not isinstance(col, columns.Counter):
             raise ValueError(u'Can only blind increment Counter columns, %s is a %s' % (name, type(col)))
-        # Increment the current value, if any.
-        try:
-            values = self._values
-        except AttributeError:
-            pass
-        else:
-            try:
-                values[name] += value
-            except KeyError:
-                pass
-
-        # Increment the dirty value, if any.
-        try:
-            dirties = self._dirties
-        except AttributeError:
-            self._dirties = {name: value}
-        else:
-            try:
-                dirties[name] += value
-            except KeyError:
-                dirties[name] = value
+        _increment(self, name, value, load=False)
 
 
 class WrappedQuerySet(ModelQuerySet):
+
+    # True if the last query's rows came from the QUERY_CACHE.
+    _from_query_cache = False
+
+    # (model class, column) pairs to load after the query, see prefetch().
+    _prefetch = ()
+
     def __init__(self, session_instance, session_class):
         self._session_instance = session_instance
         self._session_class = session_class
@@ -482,9 +2756,202 @@ class WrappedQuerySet(ModelQuerySet):
 
         super(WrappedQuerySet, self).__init__(session_class.id_mapped_class)
 
+    def _select_fields(self):
+        fields = super(WrappedQuerySet, self)._select_fields()
+        if (self._defer_fields or self._only_fields) and not self._values_list:
+            # The identity map needs the primary key of every instance.
+            fields = [col.db_field_name
+                      for col in self.model._primary_keys.values()
+                      if col.db_field_name not in fields] + fields
+        return fields
+
+    def prefetch(self, model_class, via):
+        """Load the model_class rows the results refer to in column via.
+
+        via holds the primary key of a model_class row.  Once the query has
+        run, the rows not already in the identity map are loaded with a few
+        IN queries, so that model_class(result.via) needs no query of its
+        own.  Keys found missing are remembered, as by get().
+
+        """
+        if via not in self.model._columns:
+            raise QueryException("Can't prefetch through unknown column '{}'".format(via))
+        if len(model_class.id_mapped_class._primary_keys) != 1:
+            raise QueryException(
+                    "Can only prefetch models with one primary key column, not {}".format(
+                        model_class.__name__))
+        clone = copy.deepcopy(self)
+        clone._prefetch = clone._prefetch + ((model_class, via),)
+        return clone
+
+    def _execute_query(self):
+        if self._result_cache is not None:
+            return
+        self._query_results()
+        if self._prefetch and not self._values_list:
+            self._load_prefetched()
+
+    def _query_results(self):
+        key_range = self._local_key_range()
+        if key_range is not None:
+            session = get_session()
+            if session._is_loaded(self._session_class, key_range):
+                self._result_cache = self._local_result(session)
+                self._construct_result = lambda instance: instance
+                return
+        super(WrappedQuerySet, self)._execute_query()
+        if key_range is not None and (self._limit is None or
+                                      len(self._result_cache) < self._limit):
+            # The whole slice was returned.  Build every instance, so that
+            # they are all in the identity map.
+            if self._result_cache:
+                self._fill_result_cache_to_idx(len(self._result_cache) - 1)
+            session._record_loaded(self._session_class, key_range)
+
+    def _load_prefetched(self):
+        if self._result_cache:
+            self._fill_result_cache_to_idx(len(self._result_cache) - 1)
+        session = get_session()
+        for model_class, via in self._prefetch:
+            [(name, col)] = model_class.id_mapped_class._primary_keys.items()
+            by_key = session.instances_by_class.get(model_class, {})
+            keys = set()
+            for instance in self._result_cache:
+                try:
+                    value = getattr(instance, via)
+                except AttributeUnavailable:
+                    continue
+                if value is None:
+                    continue
+                value = col.to_python(value)
+                loaded = by_key.get((value,))
+                if loaded is not None and not _is_blind(loaded):
+                    continue
+                if session.is_missing(model_class, (col.to_database(value),)):
+                    continue
+                keys.add(value)
+            keys = list(keys)
+            for start in xrange(0, len(keys), PREFETCH_CHUNK_SIZE):
+                chunk = keys[start:start + PREFETCH_CHUNK_SIZE]
+                query = model_class.objects.filter(**{name + '__in': chunk})
+                found = set(getattr(instance, name) for instance in query)
+                for value in chunk:
+                    if value not in found:
+                        session.add_missing(model_class, (col.to_database(value),))
+
+    def _local_key_range(self):
+        """Return the slice of a partition this query loads, if it can be
+        answered from the identity map, else None."""
+        if (self._values_list or self._defer_fields or self._only_fields or
+                self._order or self._batch):
+            return None
+        return _key_range(self.model, self._where)
+
+    def _local_result(self, session):
+        """Return the instances this query would load, in Cassandra's order."""
+        instances = [instance
+                     for instance in session.instances_by_class.get(self._session_class, {}).values()
+                     if not _is_blind(instance) and _matches(instance, self._where)]
+        # Sort by each clustering key in turn, last first, in its clustering
+        # order.
+        for name, col in reversed(self.model._clustering_keys.items()):
+            instances.sort(key=lambda instance: _sort_key(col.to_database(getattr(instance, name))),
+                           reverse=(col.clustering_order or '').lower() == 'desc')
+        if self._limit:
+            instances = instances[:self._limit]
+        return instances
+
+    def get(self, *args, **kwargs):
+        if args or kwargs:
+            return self.filter(*args, **kwargs).get()
+        key = self._primary_key_lookup()
+        if key is not None:
+            session = get_session()
+            if session.is_missing(self._session_class, key):
+                raise self.model.DoesNotExist
+        try:
+            return super(WrappedQuerySet, self).get()
+        except self.model.DoesNotExist:
+            if key is not None:
+                session.add_missing(self._session_class, key)
+            raise
+
+    def _primary_key_lookup(self):
+        """Return the primary key this query looks up, or None.
+
+        The key is in database form.  Only queries with nothing but an
+        equality on each primary key column are lookups.
+
+        """
+        primary_keys = self.model._primary_keys
+        if len(self._where) != len(primary_keys):
+            return None
+        values = {}
+        for clause in self._where:
+            # Note: InOperator is an EqualsOperator subclass.
+            if type(clause.operator) is not EqualsOperator:
+                return None
+            values[clause.field] = clause.value
+        try:
+            key = tuple(values[col.db_field_name] for col in primary_keys.values())
+            hash(key)
+        except (KeyError, TypeError):
+            return None
+        return key
+
+    def _execute(self, q):
+        # A clone of a queryset the caches answered starts out with its flag.
+        self._from_query_cache = False
+        partition = self._cached_partition(q)
+        if partition is None:
+            return self._execute_cached(q)
+        cache = PARTITION_CACHE
+        rows = cache.get(self.model, partition, self._limit)
+        if rows is not None:
+            self._from_query_cache = True
+            return rows
+        # Taken before the query, so that a save() during it makes the
+        # result stale.
+        generation = cache.generation(q.table)
+        rows = list(self._execute_cached(q))
+        return cache.put(self.model, partition, generation, rows,
+                         self._limit is None or len(rows) < self._limit)
+
+    def _cached_partition(self, q):
+        """Return the partition whose first rows q reads, if the
+        PARTITION_CACHE can answer it, else None."""
+        if (PARTITION_CACHE is None or self._batch or
+                not isinstance(q, SelectStatement) or q.count or q.fields or
+                self._values_list or self._order):
+            return None
+        key_range = _key_range(self.model, self._where)
+        if key_range is None or key_range[1] or key_range[2] or key_range[3]:
+            return None
+        return key_range[0]
+
+    def _execute_cached(self, q):
+        cache = QUERY_CACHE
+        if cache is None or self._batch or not isinstance(q, SelectStatement):
+            return super(WrappedQuerySet, self)._execute(q)
+        key = cache.key(q)
+        rows = cache.get(key)
+        self._from_query_cache = rows is not None
+        if rows is None:
+            # Taken before the query, so that a save() during it makes the
+            # result stale.
+            generation = cache.generation(q.table)
+            rows = super(WrappedQuerySet, self)._execute(q)
+            rows = cache.put(key, q.table, generation, rows)
+        return rows
+
     def _get_result_constructor(self):
         """ Returns a function that will be used to instantiate query results """
         if not self._values_list: # we want models
+            if self._from_query_cache:
+                partial = bool(self._defer_fields or self._only_fields)
+                return lambda rows: self._session_class._cached_instance(rows, partial)
+            if self._defer_fields or self._only_fields:
+                return lambda rows: self._session_class._construct_instance(rows, partial=True)
             return lambda rows: self._session_class._construct_instance(rows)
         elif self._flat_values_list: # the user has requested flattened list (1 value per row)
             return lambda row: row.popitem()[1]
@@ -516,19 +2983,23 @@ class OwnedSet(set):
         super(OwnedSet, self).__init__(*args, **kwargs)
 
     def mark_dirty(self):
+        # Called after each change, so that the journal records the result.
         self.owner._mark_dirty(self.name, self)
 
     def add(self, *args, **kwargs):
+        result = super(OwnedSet, self).add(*args, **kwargs)
         self.mark_dirty()
-        return super(OwnedSet, self).add(*args, **kwargs)
+        return result
 
     def remove(self, *args, **kwargs):
+        result = super(OwnedSet, self).remove(*args, **kwargs)
         self.mark_dirty()
-        return super(OwnedSet, self).remove(*args, **kwargs)
+        return result
 
     def clear(self, *args, **kwargs):
+        result = super(OwnedSet, self).clear(*args, **kwargs)
         self.mark_dirty()
-        return super(OwnedSet, self).clear(*args, **kwargs)
+        return result
 
     def copy(self, *args, **kwargs):
         c = super(OwnedSet, self).copy(*args, **kwargs)
@@ -537,28 +3008,34 @@ class OwnedSet(set):
         return c
 
     def difference_update(self, *args, **kwargs):
+        result = super(OwnedSet, self).difference_update(*args, **kwargs)
         self.mark_dirty()
-        return super(OwnedSet, self).difference_update(*args, **kwargs)
+        return result
 
     def discard(self, *args, **kwargs):
+        result = super(OwnedSet, self).discard(*args, **kwargs)
         self.mark_dirty()
-        return super(OwnedSet, self).discard(*args, **kwargs)
+        return result
 
     def intersection_update(self, *args, **kwargs):
+        result = super(OwnedSet, self).intersection_update(*args, **kwargs)
         self.mark_dirty()
-        return super(OwnedSet, self).intersection_update(*args, **kwargs)
+        return result
 
     def pop(self, *args, **kwargs):
+        result = super(OwnedSet, self).pop(*args, **kwargs)
         self.mark_dirty()
-        return super(OwnedSet, self).pop(*args, **kwargs)
+        return result
 
     def symmetric_difference_update(self, *args, **kwargs):
+        result = super(OwnedSet, self).symmetric_difference_update(*args, **kwargs)
         self.mark_dirty()
-        return super(OwnedSet, self).symmetric_difference_update(*args, **kwargs)
+        return result
 
     def update(self, *args, **kwargs):
+        result = super(OwnedSet, self).update(*args, **kwargs)
         self.mark_dirty()
-        return super(OwnedSet, self).update(*args, **kwargs)
+        return result
 
 
 class OwnedList(list):
@@ -572,40 +3049,49 @@ class OwnedList(list):
         self.owner._mark_dirty(self.name, self)
 
     def __setitem__(self, *args, **kwargs):
+        result = super(OwnedList, self).__setitem__(*args, **kwargs)
         self.mark_dirty()
-        return super(OwnedList, self).__setitem__(*args, **kwargs)
+        return result
 
     def __setslice__(self, *args, **kwargs):
+        result = super(OwnedList, self).__setslice__(*args, **kwargs)
         self.mark_dirty()
-        return super(OwnedList, self).__setslice__(*args, **kwargs)
+        return result
 
     def append(self, *args, **kwargs):
+        result = super(OwnedList, self).append(*args, **kwargs)
         self.mark_dirty()
-        return super(OwnedList, self).append(*args, **kwargs)
+        return result
 
     def extend(self, *args, **kwargs):
+        result = super(OwnedList, self).extend(*args, **kwargs)
         self.mark_dirty()
-        return super(OwnedList, self).extend(*args, **kwargs)
+        return result
 
     def insert(self, *args, **kwargs):
+        result = super(OwnedList, self).insert(*args, **kwargs)
         self.mark_dirty()
-        return super(OwnedList, self).insert(*args, **kwargs)
+        return result
 
     def pop(self, *args, **kwargs):
+        result = super(OwnedList, self).pop(*args, **kwargs)
         self.mark_dirty()
-        return super(OwnedList, self).pop(*args, **kwargs)
+        return result
 
     def remove(self, *args, **kwargs):
+        result = super(OwnedList, self).remove(*args, **kwargs)
         self.mark_dirty()
-        return super(OwnedList, self).remove(*args, **kwargs)
+        return result
 
     def reverse(self, *args, **kwargs):
+        result = super(OwnedList, self).reverse(*args, **kwargs)
         self.mark_dirty()
-        return super(OwnedList, self).reverse(*args, **kwargs)
+        return result
 
     def sort(self, *args, **kwargs):
+        result = super(OwnedList, self).sort(*args, **kwargs)
         self.mark_dirty()
-        return super(OwnedList, self).sort(*args, **kwargs)
+        return result
 
 
 class OwnedMap(dict):
@@ -619,12 +3105,14 @@ class OwnedMap(dict):
         self.owner._mark_dirty(self.name, self)
 
     def __setitem__(self, *args, **kwargs):
+        result = super(OwnedMap, self).__setitem__(*args, **kwargs)
         self.mark_dirty()
-        return super(OwnedMap, self).__setitem__(*args, **kwargs)
+        return result
 
     def clear(self, *args, **kwargs):
+        result = super(OwnedMap, self).clear(*args, **kwargs)
         self.mark_dirty()
-        return super(OwnedMap, self).clear(*args, **kwargs)
+        return result
 
     def copy(self, *args, **kwargs):
         c = super(OwnedMap, self).copy(*args, **kwargs)
@@ -633,24 +3121,29 @@ class OwnedMap(dict):
         return c
 
     def pop(self, *args, **kwargs):
+        result = super(OwnedMap, self).pop(*args, **kwargs)
         self.mark_dirty()
-        return super(OwnedMap, self).pop(*args, **kwargs)
+        return result
 
     def popitem(self, *args, **kwargs):
+        result = super(OwnedMap, self).popitem(*args, **kwargs)
         self.mark_dirty()
-        return super(OwnedMap, self).popitem(*args, **kwargs)
+        return result
 
     def update(self, *args, **kwargs):
+        result = super(OwnedMap, self).update(*args, **kwargs)
         self.mark_dirty()
-        return super(OwnedMap, self).update(*args, **kwargs)
+        return result
 
     def remove(self, *args, **kwargs):
+        result = super(OwnedMap, self).remove(*args, **kwargs)
         self.mark_dirty()
-        return super(OwnedMap, self).remove(*args, **kwargs)
+        return result
 
     def setdefault(self, *args, **kwargs):
+        result = super(OwnedMap, self).setdefault(*args, **kwargs)
         self.mark_dirty()
-        return super(OwnedMap, self).setdefault(*args, **kwargs)
+        return result
 
 
 class ColumnDescriptor(object):
@@ -711,11 +3204,69 @@ class ColumnDescriptor(object):
         """
         if instance:
             if self.column.can_delete:
-                raise NotImplementedError
+                # The null is written as a column delete at the next save.
+                self.__set__(instance, None)
             else:
                 raise AttributeError('cannot delete {} columns'.format(self.column.column_name))
 
 
+class ContainerColumnDescriptor(ColumnDescriptor):
+    """
+    ColumnDescriptor for container columns.  Values loaded from Cassandra
+    are stored as the driver returned them, and wrapped in an Owned*
+    container the first time they are read.
+    """
+
+    def __init__(self, column):
+        super(ContainerColumnDescriptor, self).__init__(column)
+        if isinstance(column, columns.Set):
+            self.owned_class = OwnedSet
+            passthrough = _passthrough(column.value_col)
+        elif isinstance(column, columns.List):
+            self.owned_class = OwnedList
+            passthrough = _passthrough(column.value_col)
+        elif isinstance(column, columns.Map):
+            self.owned_class = OwnedMap
+            passthrough = (_passthrough(column.key_col) and
+                           _passthrough(column.value_col))
+        else:
+            raise TypeError('Unknown container column {}'.format(column))
+        # When the elements need no conversion, the Owned* container is
+        # made from the driver's value directly, skipping to_python()'s
+        # copy.
+        self.passthrough = passthrough
+
+    def __get__(self, instance, owner):
+        if instance:
+            name = self.column.column_name
+            try:
+                value = instance._values[name]
+            except (AttributeError, KeyError,):
+                raise AttributeUnavailable(instance, name)
+            if type(value) is not self.owned_class:
+                if value is None:
+                    value = self.owned_class(instance, name)
+                elif self.passthrough:
+                    value = self.owned_class(instance, name, value)
+                else:
+                    value = self.owned_class(instance, name,
+                                             self.column.to_python(value))
+                instance._values[name] = value
+            return value
+        else:
+            return self.query_evaluator
+
+
+# Element column types whose to_python() returns the values the driver
+# decodes unchanged.
+_PASSTHROUGH_COLUMNS = (columns.Ascii, columns.Text, columns.Bytes,
+                        columns.UUID, columns.TimeUUID)
+
+
+def _passthrough(col):
+    return type(col) in _PASSTHROUGH_COLUMNS
+
+
 class WrappedResponse(int):
     # This is necessary so that set knows it is getting set as the result of
     # an __iadd__ call and not a regular assignment.
@@ -724,9 +3275,57 @@ class WrappedResponse(int):
     pass
 
 
+# Increments are mostly small, so their responses are made once.
+_SMALL_RESPONSES = dict((i, WrappedResponse(i)) for i in xrange(-128, 1025))
+
+
 class WrappedInt(int):
     def __iadd__(self, value):
-        return WrappedResponse(value)
+        try:
+            return _SMALL_RESPONSES[value]
+        except (KeyError, TypeError):
+            return WrappedResponse(value)
+
+
+# Read for counters that have no value.
+_WRAPPED_ZERO = WrappedInt(0)
+
+
+def _increment(instance, name, value, load):
+    """Add value to a counter's current and dirty values.
+
+    load -- True to set the current value if it is not loaded, as an
+            increment of an instance created in this session does
+
+    The sums are stored as plain ints, since += on a WrappedInt would
+    answer a WrappedResponse.
+
+    """
+    with instance._lock or _NO_LOCK:
+        try:
+            values = instance._values
+        except AttributeError:
+            if load:
+                instance._values = {name: value}
+        else:
+            try:
+                values[name] = values[name] + value
+            except KeyError:
+                if load:
+                    values[name] = value
+
+        try:
+            dirties = instance._dirties
+        except AttributeError:
+            instance._dirties = {name: value}
+        else:
+            try:
+                dirties[name] = dirties[name] + value
+            except KeyError:
+                dirties[name] = value
+    journal = _journal()
+    if journal is not None:
+        journal.record_increment(instance, name, value)
 
 
 class CounterColumnDescriptor(ColumnDescriptor):
@@ -741,11 +3340,19 @@ class CounterColumnDescriptor(ColumnDescriptor):
         :type instance: Model
         """
         if instance:
+            name = self.column.column_name
             try:
-                existing_value = instance._values[self.column.column_name] or 0
-                return WrappedInt(existing_value)
+                values = instance._values
+                existing_value = values[name]
             except (AttributeError, KeyError,):
-                raise AttributeUnavailable(instance, self.column.column_name)
+                raise AttributeUnavailable(instance, name)
+            if type(existing_value) is WrappedInt:
+                return existing_value
+            if existing_value is None:
+                return _WRAPPED_ZERO
+            # Keep the wrapper, so later reads need not make another.
+            existing_value = values[name] = WrappedInt(existing_value)
+            return existing_value
         else:
             return self.query_evaluator
 
@@ -755,30 +3362,8 @@ class CounterColumnDescriptor(ColumnDescriptor):
         TODO: use None instance to create update statements
         """
         if instance:
-            if isinstance(value, WrappedResponse):
-                name = self.column.column_name
-                value = int(value)
-                # Increment the current value, if any.
-                try:
-                    values = instance._values
-                except AttributeError:
-                    instance._values = {name: value}
-                else:
-                    try:
-                        values[name] += value
-                    except KeyError:
-                        values[name] = value
-
-                # Increment the dirty value, if any.
-                try:
-                    dirties = instance._dirties
-                except AttributeError:
-                    instance._dirties = {name: value}
-                else:
-                    try:
-                        dirties[name] += value
-                    except KeyError:
-                        dirties[name] = value
+            if type(value) is WrappedResponse:
+                _increment(instance, self.column.column_name, int(value), load=True)
             else:
                 raise AttributeError('cannot assign to counter, use +=')
         else:
@@ -791,6 +3376,18 @@ class Empty(object):
 EMPTY = Empty()
 
 
+class _NoLock(object):
+    """Stands in for the lock of an instance outside a ConcurrentSession."""
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_NO_LOCK = _NoLock()
+
+
 class VerifyResult(object):
 
     def __init__(self, model, is_missing=False):
@@ -848,27 +3445,156 @@ class VerifyResult(object):
     def __repr__(self):
         return 'VerifyResult({})'.format(self.model.__name__)
 
+    def to_dict(self):
+        """Return the result as a dict of JSON types, see from_dict()."""
+        if self.is_extra:
+            model = self.model
+        else:
+            model = self.model.column_family_name()
+        return {
+            'model': model,
+            'is_missing': self.is_missing,
+            'is_extra': self.is_extra,
+            'missing': sorted(self.missing),
+            'extra': sorted(self.extra),
+            'different': sorted(self.different),
+            'missing_indexes': sorted(self.missing_indexes),
+            'extra_indexes': sorted(self.extra_indexes),
+        }
 
-def verify(*models, **kwargs):
-    ignore_extra = kwargs.get('ignore_extra', {})
-    results = {}
-    by_keyspace = {}
-    by_cf = {}
-    results = {}
-    for model in models:
-        ks_name = model._get_keyspace()
-        try:
-            by_keyspace[ks_name].add(model)
-        except KeyError:
-            by_keyspace[ks_name] = set([model])
-        cf_name = model.column_family_name(include_keyspace=False)
-        by_cf[cf_name] = model
-        results[model] = VerifyResult(model)
+    @classmethod
+    def from_dict(cls, data, models=()):
+        """Return the result to_dict() returned data for.
 
-    for keyspace, models in by_keyspace.items():
-        query_result = cqlengine.connection.get_session().execute(
+        models -- the model classes verified, to find the result's model
+                  by its column family name
+
+        """
+        by_name = {model.column_family_name(): model for model in models}
+        result = cls(by_name.get(data['model'], data['model']), data['is_missing'])
+        result.is_extra = data['is_extra']
+        result.missing = set(data['missing'])
+        result.extra = set(data['extra'])
+        result.different = set(data['different'])
+        result.missing_indexes = set(data['missing_indexes'])
+        result.extra_indexes = set(data['extra_indexes'])
+        return result
+
+
+class SchemaSnapshot(object):
+    """The tables and indexes of some keyspaces, read once for verify().
+
+    use: snapshot = SchemaSnapshot()
+         verify(*models, snapshot=snapshot)
+         verify(*more_models, snapshot=snapshot)
+
+    Each keyspace is read the first time it is needed, from the schema
+    tables, with the queries for all keyspaces in flight at once.  Without
+    a layout, the driver's schema metadata is used instead when it has the
+    keyspace.  Later calls reuse what was read, so a snapshot goes stale
+    once the schema changes.
+
+    layout -- SYSTEM_TABLES for Cassandra 2.x's system.schema_* tables,
+              SYSTEM_SCHEMA for the system_schema keyspace of Cassandra 3.0
+              and later, or None to pick by the cluster's release_version
+
+    """
+
+    def __init__(self, layout=None):
+        self.layout = layout
+        # The layout picked when none was given.
+        self._found_layout = None
+        # Keyspace name -> {table name -> table info}, see SchemaLayout.
+        self.keyspaces = {}
+
+    def load(self, *keyspaces):
+        """Read the keyspaces not read yet, and return self."""
+        unread = []
+        for keyspace in set(keyspaces):
+            if keyspace not in self.keyspaces:
+                tables = None
+                if self.layout is None:
+                    tables = _metadata_tables(keyspace)
+                if tables is None:
+                    unread.append(keyspace)
+                else:
+                    self.keyspaces[keyspace] = tables
+        if unread:
+            session = cqlengine.connection.get_session()
+            layout = self.layout
+            if layout is None:
+                if self._found_layout is None:
+                    self._found_layout = _schema_layout()
+                layout = self._found_layout
+            futures = [(keyspace,
+                        [session.execute_async(query, {'ks_name': keyspace})
+                         for query in layout.queries])
+                       for keyspace in unread]
+            for keyspace, keyspace_futures in futures:
+                self.keyspaces[keyspace] = layout.tables(
+                        *[future.result() for future in keyspace_futures])
+        return self
+
+    def tables(self, keyspace):
+        """Return {table name -> table info} for keyspace."""
+        return self.load(keyspace).keyspaces[keyspace]
+
+
+def _metadata_tables(keyspace):
+    """Return the tables of keyspace from the driver's schema metadata, or
+    None if it doesn't have the keyspace."""
+    cluster = cqlengine.connection.cluster
+    if cluster is None or cluster.metadata is None:
+        return None
+    keyspace_metadata = cluster.metadata.keyspaces.get(keyspace)
+    if keyspace_metadata is None:
+        return None
+    tables = {}
+    for name, table in keyspace_metadata.tables.items():
+        key_names = set(col.name for col in table.partition_key + table.clustering_key)
+        tables[name] = {
+            'cf': name,
+            'partition_keys': [col.name for col in table.partition_key],
+            'partition_key_types': [col.data_type.cass_parameterized_type(full=True)
+                                    for col in table.partition_key],
+            'primary_keys': [col.name for col in table.clustering_key],
+            'primary_key_types': [col.data_type.cass_parameterized_type(full=True)
+                                  for col in table.clustering_key],
+            'fields': {col.name: col.data_type.cass_parameterized_type(full=True)
+                       for col in table.columns.values()
+                       if col.name not in key_names},
+            'indexes': set(col.name for col in table.columns.values()
+                           if col.index is not None),
+        }
+    return tables
+
+
+class SchemaLayout(object):
+    """How a Cassandra version lays out its schema tables.
+
+    tables() turns the rows of queries, run for one keyspace, into
+    {table name -> table info}.  Each table's info is a dict of its
+    partition keys, its clustering keys ('primary_keys') and their marshal
+    types, its other columns ('fields', name -> marshal type) and the names
+    of its indexed columns ('indexes').
+
+    """
+
+    queries = ()
+
+    def tables(self, *results):
+        raise NotImplementedError
+
+
+class SystemTablesLayout(SchemaLayout):
+    """system.schema_columnfamilies and schema_columns, up to Cassandra 2.x."""
+
+    queries = (
         "SELECT columnfamily_name, key_aliases, key_validator, column_aliases, comparator from system.schema_columnfamilies WHERE keyspace_name = %(ks_name)s",
-                {'ks_name': ks_name})
+        "SELECT * from system.schema_columns WHERE keyspace_name = %(ks_name)s",
+    )
+
+    def tables(self, query_result, column_result):
         tables = {}
         for result in query_result:
             columnfamily_name = result['columnfamily_name']
@@ -888,10 +3614,242 @@ def verify(*models, **kwargs):
                 'partition_keys': partition_keys,
                 'partition_key_types': partition_key_types,
                 'primary_keys': primary_keys,
-                'primary_key_types': primary_key_types
+                'primary_key_types': primary_key_types,
+                'fields': {},
+                'indexes': set(),
             }
             tables[columnfamily_name] = item
+        for result in column_result:
+            item = tables.get(result['columnfamily_name'])
+            if item is None:
+                continue
+            # Before Cassandra 2.0 there is no type, and only regular
+            # columns are listed.
+            if result.get('type', 'regular') == 'regular':
+                item['fields'][result['column_name']] = result['validator']
+            if result.get('index_name'):
+                item['indexes'].add(result['column_name'])
+        return tables
+
+
+class SystemSchemaLayout(SchemaLayout):
+    """The system_schema keyspace, from Cassandra 3.0 on.
+
+    Columns come with their kind and position, and with CQL type names,
+    which are mapped to the marshal types verify() compares.
+
+    """
+
+    queries = (
+        "SELECT * FROM system_schema.columns WHERE keyspace_name = %(ks_name)s",
+        "SELECT * FROM system_schema.indexes WHERE keyspace_name = %(ks_name)s",
+    )
+
+    def tables(self, column_result, index_result):
+        tables = {}
+        keys = {}
+        for result in column_result:
+            table_name = result['table_name']
+            item = tables.get(table_name)
+            if item is None:
+                item = tables[table_name] = {
+                    'cf': table_name,
+                    'fields': {},
+                    'indexes': set(),
+                }
+                keys[table_name] = ([], [])
+            name = result['column_name']
+            kind = result['kind']
+            marshal_type = _cql_to_marshal(result['type'])
+            if kind == 'partition_key':
+                keys[table_name][0].append((result['position'], name, marshal_type))
+            elif kind == 'clustering':
+                if result['clustering_order'] == 'desc':
+                    marshal_type = u'org.apache.cassandra.db.marshal.ReversedType({})'.format(marshal_type)
+                keys[table_name][1].append((result['position'], name, marshal_type))
+            elif kind == 'regular':
+                item['fields'][name] = marshal_type
+        for table_name, (partition_keys, clustering_keys) in keys.items():
+            item = tables[table_name]
+            partition_keys.sort()
+            clustering_keys.sort()
+            item['partition_keys'] = [name for position, name, kind in partition_keys]
+            item['partition_key_types'] = [kind for position, name, kind in partition_keys]
+            item['primary_keys'] = [name for position, name, kind in clustering_keys]
+            item['primary_key_types'] = [kind for position, name, kind in clustering_keys]
+        for result in index_result:
+            item = tables.get(result['table_name'])
+            target = (result.get('options') or {}).get('target')
+            if item is None or not target:
+                continue
+            # The target is the column name, maybe quoted and maybe in
+            # keys(), values(), entries() or full().
+            if target.endswith(')') and '(' in target:
+                target = target[target.index('(') + 1:-1]
+            if target.startswith('"') and target.endswith('"'):
+                target = target[1:-1].replace('""', '"')
+            item['indexes'].add(target)
+        return tables
+
+
+SYSTEM_TABLES = SystemTablesLayout()
+SYSTEM_SCHEMA = SystemSchemaLayout()
+
+
+def _schema_layout():
+    """Return the SchemaLayout of the cluster's Cassandra version."""
+    rows = cqlengine.connection.get_session().execute(
+            "SELECT release_version FROM system.local")
+    major = int(rows[0]['release_version'].split('.')[0])
+    if major >= 3:
+        return SYSTEM_SCHEMA
+    return SYSTEM_TABLES
+
+
+_MARSHAL_PREFIX = 'org.apache.cassandra.db.marshal.'
+
+# CQL type name -> marshal type, without _MARSHAL_PREFIX.
+_CQL_MARSHAL_TYPES = {
+    'ascii': 'AsciiType',
+    'bigint': 'LongType',
+    'blob': 'BytesType',
+    'boolean': 'BooleanType',
+    'counter': 'CounterColumnType',
+    'date': 'SimpleDateType',
+    'decimal': 'DecimalType',
+    'double': 'DoubleType',
+    'duration': 'DurationType',
+    'float': 'FloatType',
+    'inet': 'InetAddressType',
+    'int': 'Int32Type',
+    'smallint': 'ShortType',
+    'text': 'UTF8Type',
+    'time': 'TimeType',
+    'timestamp': 'TimestampType',
+    'timeuuid': 'TimeUUIDType',
+    'tinyint': 'ByteType',
+    'uuid': 'UUIDType',
+    'varchar': 'UTF8Type',
+    'varint': 'IntegerType',
+    'frozen': 'FrozenType',
+    'list': 'ListType',
+    'map': 'MapType',
+    'set': 'SetType',
+    'tuple': 'TupleType',
+}
+
+
+def _cql_to_marshal(cql_type):
+    """Return the marshal type of a CQL type, like 'map<text, int>'."""
+    name, bracket, parameters = cql_type.strip().partition('<')
+    name = name.strip().lower()
+    marshal_type = _MARSHAL_PREFIX + _CQL_MARSHAL_TYPES.get(name, name)
+    if not bracket:
+        return marshal_type
+    # Split the parameters on the commas outside of nested <>.
+    split = []
+    depth = 0
+    start = 0
+    parameters = parameters.rstrip()[:-1]
+    for i, c in enumerate(parameters):
+        if c == '<':
+            depth += 1
+        elif c == '>':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            split.append(parameters[start:i])
+            start = i + 1
+    split.append(parameters[start:])
+    return '{}({})'.format(marshal_type, ','.join(_cql_to_marshal(p) for p in split))
+
+
+def verify(*models, **kwargs):
+    """Compare models with their column families, and return a
+    VerifyResult for each model or column family that differs.
+
+    ignore_extra -- names of column families not to report as extra
+    snapshot -- a SchemaSnapshot to read the schema from, and add the
+                keyspaces it hasn't read yet to
+    cache_file -- path of a file to keep the results in.  While the models
+                  and the cluster's schema version are unchanged, the
+                  results are read back from it instead of verified again.
+    timings -- a dict to set the seconds spent comparing each model in
+
+    """
+    ignore_extra = kwargs.get('ignore_extra', {})
+    snapshot = kwargs.get('snapshot')
+    cache_file = kwargs.get('cache_file')
+    timings = kwargs.get('timings')
+    if cache_file is None:
+        return _verify(models, ignore_extra, snapshot, timings)
+    # Read before verifying, so that a schema change during it makes the
+    # saved results stale.
+    fingerprint = {'models': _models_fingerprint(models, ignore_extra),
+                   'schema_version': _schema_version()}
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if cached['fingerprint'] == fingerprint:
+            return [VerifyResult.from_dict(data, models) for data in cached['results']]
+    except (IOError, ValueError, KeyError, TypeError):
+        pass
+    results = _verify(models, ignore_extra, snapshot, timings)
+    # Written aside and renamed, so that a concurrent start never reads
+    # half of the file.
+    temp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+    with open(temp_file, 'w') as f:
+        json.dump({'fingerprint': fingerprint,
+                   'results': [result.to_dict() for result in results]},
+                  f, sort_keys=True)
+    os.rename(temp_file, cache_file)
+    return results
+
+
+def _models_fingerprint(models, ignore_extra=()):
+    """Return a hash of what verify() checks of models."""
+    definitions = []
+    for model in models:
+        definitions.append([
+            model.column_family_name(),
+            sorted([col.get_column_def(),
+                    col.partition_key,
+                    col.primary_key,
+                    col.clustering_order,
+                    bool(col.index)]
+                   for col in model._columns.values())])
+    definitions.sort()
+    data = json.dumps([definitions, sorted(ignore_extra)], sort_keys=True)
+    return hashlib.sha1(data).hexdigest()
+
+
+def _schema_version():
+    rows = cqlengine.connection.get_session().execute(
+            "SELECT schema_version FROM system.local")
+    return str(rows[0]['schema_version'])
+
+
+def _verify(models, ignore_extra, snapshot, timings=None):
+    by_keyspace = {}
+    by_cf = {}
+    results = {}
+    for model in models:
+        ks_name = model._get_keyspace()
+        try:
+            by_keyspace[ks_name].add(model)
+        except KeyError:
+            by_keyspace[ks_name] = set([model])
+        cf_name = model.column_family_name(include_keyspace=False)
+        by_cf[(ks_name, cf_name)] = model
+        results[model] = VerifyResult(model)
+
+    if snapshot is None:
+        snapshot = SchemaSnapshot()
+    snapshot.load(*by_keyspace)
+
+    for keyspace, models in by_keyspace.items():
+        tables = snapshot.tables(keyspace)
         for model in models:
+            started = time.time()
             cf_name = model.column_family_name(include_keyspace=False)
             db_field_names = {col.db_field_name: col for name, col in model._columns.items()}
             result = results[model]
@@ -900,8 +3858,7 @@ def verify(*models, **kwargs):
                 result.is_missing = True
             else:
                 table_info = tables[cf_name]
-                fields = get_fields(model)
-                fields = {field.name: field.type for field in fields}
+                fields = table_info['fields']
                 for name, field_type in fields.iteritems():
                     # If field is missing, that's an error.
                     if name not in db_field_names:
@@ -966,56 +3923,22 @@ def verify(*models, **kwargs):
                     # Primary keys are not listed in fields.
                     if not col.primary_key and name not in fields:
                         result.missing.add(col.column_name)
+            if timings is not None:
+                timings[model] = time.time() - started
         for cf in tables:
-            if cf not in by_cf and cf not in ignore_extra:
+            if (keyspace, cf) not in by_cf and cf not in ignore_extra:
                 result = VerifyResult(cf)
                 result.is_extra = True
-                results[cf] = result
-        model_indexes = {}
+                results[(keyspace, cf)] = result
         for model in models:
-            this_model_indexes = {col.db_field_name: col for name, col in model._columns.items() if col.index}
-            if this_model_indexes:
-                model_indexes[model.column_family_name(include_keyspace=False)] = this_model_indexes
-        query_results = cqlengine.connection.get_session().execute(
-            "SELECT index_name from system.\"IndexInfo\" WHERE table_name=%(table_name)s",
-            {'table_name': model._get_keyspace()})
-        cassandra_indexes = {}
-        for result_dict in query_results:
-            idx = result_dict['index_name']
-            try:
-                cf, index_name = idx.split('.')
-                look_for = 'index_{}_'.format(cf)
-                index_name = index_name[len(look_for):]
-            except ValueError:
-                cf = None
-                index_name = None
-            if cf:
-                try:
-                    cassandra_indexes[cf].add(index_name)
-                except KeyError:
-                    cassandra_indexes[cf] = set([index_name])
-        for cf, index_names in cassandra_indexes.items():
-            if cf not in model_indexes:
-                if cf not in by_cf:
-                    result = VerifyResult(cf)
-                    result.is_extra = True
-                    results[cf] = result
-                else:
-                    model = by_cf[cf]
-                    result = results[model]
-                    result.extra_indexes.add(index_name)
-            else:
-                this_model_indexes = model_indexes[cf]
-                if index_name not in this_model_indexes:
-                    model = by_cf[cf]
-                    result = results[model]
-                    result.extra_indexes.add(index_name)
-        for cf, this_model_indexes in model_indexes.items():
-            for index_name in this_model_indexes.keys():
-                if cf not in cassandra_indexes or index_name not in cassandra_indexes[cf]:
-                    model = by_cf[cf]
-                    result = results[model]
-                    result.missing_indexes.add(index_name)
+            cf_name = model.column_family_name(include_keyspace=False)
+            if cf_name not in tables:
+                continue
+            result = results[model]
+            model_indexes = set(col.db_field_name for col in model._columns.values() if col.index)
+            cassandra_indexes = tables[cf_name]['indexes']
+            result.extra_indexes.update(cassandra_indexes - model_indexes)
+            result.missing_indexes.update(model_indexes - cassandra_indexes)
 
     results = {model: result for model, result in results.items() if result.has_errors()}
 
@@ -1058,3 +3981,115 @@ def _type_to_metadata(s):
         'counter': 'org.apache.cassandra.db.marshal.CounterColumnType'
     }.get(s, s)
 
+
+
+def _module_models(module):
+    """Return {cqlengine model -> class path} for the models defined or
+    imported in module.
+
+    A SessionModel's path is its own, not that of the cqlengine model it
+    leaves in its module.
+
+    """
+    models = {}
+    wrapped = {}
+    for name, value in sorted(vars(module).items()):
+        if not isinstance(value, type):
+            continue
+        path = '{}.{}'.format(value.__module__, value.__name__)
+        if issubclass(value, IdMapModel):
+            wrapped[value.id_mapped_class] = path
+        elif issubclass(value, Model) and not value.__abstract__:
+            models.setdefault(value, path)
+    models.update(wrapped)
+    return models
+
+
+def main(argv=None):
+    """Verify the models of some modules against Cassandra, as JSON.
+
+    Exits with 0 if every model matches its column family, 1 if any
+    differs, and 2 if verify could not run.
+
+    """
+    parser = argparse.ArgumentParser(
+            description='Compare cqlengine models with their column families.')
+    parser.add_argument('modules', nargs='+', metavar='MODULE',
+                        help='dotted path of a module defining models')
+    parser.add_argument('--hosts', default='localhost',
+                        help='comma separated Cassandra hosts (default: localhost)')
+    parser.add_argument('--keyspace',
+                        help='keyspace of models that do not name one')
+    parser.add_argument('--ignore-extra', action='append', default=[], metavar='TABLE',
+                        help='column family not to report as extra (repeatable)')
+    parser.add_argument('--cache-file',
+                        help='file to keep results in while models and schema are unchanged')
+    parser.add_argument('--serial', action='store_true',
+                        help='read keyspaces one after another instead of concurrently '
+                             '(not with --cache-file)')
+    parser.add_argument('--output', type=argparse.FileType('w'), default=sys.stdout,
+                        help='file to write the JSON report to (default: stdout)')
+    args = parser.parse_args(argv)
+    if args.serial and args.cache_file:
+        # verify() reads the schema itself when the cache is stale.
+        parser.error('--serial cannot be used with --cache-file')
+
+    started = time.time()
+    # schema_seconds stays None when verify() reads the schema itself.
+    report = {'ok': False, 'schema_seconds': None}
+    # setup() replaces these, and they are put back after, for a caller in
+    # the same process.
+    cluster = cqlengine.connection.cluster
+    session = cqlengine.connection.session
+    consistency = cqlengine.connection.default_consistency_level
+    default_keyspace = cqlengine.models.DEFAULT_KEYSPACE
+    try:
+        models = {}
+        for name in args.modules:
+            models.update(_module_models(importlib.import_module(name)))
+        cqlengine.connection.setup(args.hosts.split(','), default_keyspace=args.keyspace)
+        timings = {}
+        if args.cache_file:
+            results = verify(*models, ignore_extra=args.ignore_extra,
+                             cache_file=args.cache_file, timings=timings)
+        else:
+            snapshot = SchemaSnapshot()
+            keyspaces = set(model._get_keyspace() for model in models)
+            schema_started = time.time()
+            if args.serial:
+                for keyspace in sorted(keyspaces):
+                    snapshot.load(keyspace)
+            else:
+                snapshot.load(*keyspaces)
+            report['schema_seconds'] = time.time() - schema_started
+            results = verify(*models, ignore_extra=args.ignore_extra,
+                             snapshot=snapshot, timings=timings)
+    except Exception, e:
+        report['error'] = '{}: {}'.format(type(e).__name__, e)
+        status = 2
+    else:
+        by_model = {result.model: result for result in results}
+        report['models'] = [
+            {'model': model.column_family_name(),
+             'class': models[model],
+             'seconds': timings.get(model),
+             'differences': by_model[model].to_dict() if model in by_model else None}
+            for model in sorted(models, key=lambda model: model.column_family_name())]
+        report['extra'] = sorted(result.model for result in results if result.is_extra)
+        report['ok'] = not results
+        status = 0 if report['ok'] else 1
+    finally:
+        if cqlengine.connection.cluster is not cluster:
+            cqlengine.connection.cluster.shutdown()
+        cqlengine.connection.cluster = cluster
+        cqlengine.connection.session = session
+        cqlengine.connection.default_consistency_level = consistency
+        cqlengine.models.DEFAULT_KEYSPACE = default_keyspace
+    report['seconds'] = time.time() - started
+    json.dump(report, args.output, indent=2, sort_keys=True)
+    args.output.write('\n')
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -19,6 +19,11 @@ setup(
     py_modules=[
         'cqlengine_session',
     ],
+    entry_points={
+        'console_scripts': [
+            'cqlengine-verify = cqlengine_session:main',
+        ],
+    },
     author='Michael Cyrulnik',
     author_email='michael@chill.com',
     url='https://github.com/chilldotcom/CQLEngine-Session',
@@ -3,7 +3,7 @@ import json
 import unittest
 import uuid
 
-from cqlengine_session import clear, OwnedList, OwnedMap, save, SessionModel
+from cqlengine_session import clear, OwnedList, OwnedMap, OwnedSet, save, SessionModel
 from cqlengine import Model, ValidationError
 from cqlengine.connection import get_cluster, setup
 from cqlengine.management import create_keyspace, delete_keyspace
@@ -115,6 +115,25 @@ class TestSetColumn(BaseTestCase):
         assert 'kai' in m2.text_set
         assert 'andreas' in m2.text_set
 
+    def test_lazy_wrapping(self):
+        """ Tests that loaded sets are wrapped when first read """
+        m1 = TestSetModel.create(int_set={1, 2}, text_set={'kai'})
+        m1_key = m1.partition
+        save()
+        clear()
+        m2 = TestSetModel.get(partition=m1_key)
+        assert not isinstance(m2._values['text_set'], OwnedSet)
+
+        assert isinstance(m2.text_set, OwnedSet)
+        assert m2.text_set is m2.text_set
+        assert m2.int_set == {1, 2}
+        m2.text_set.add('andreas')
+        save()
+        clear()
+
+        m3 = TestSetModel.get(partition=m1_key)
+        assert m3.text_set == {'kai', 'andreas'}
+
     def test_type_validation(self):
         """
         Tests that attempting to use the wrong types will raise an exception
@@ -157,3 +157,20 @@ class TestCounterColumn(BaseTestCase):
         x = new.counter
         x += 20
         assert new.counter == 34
+
+    def test_reads_share_increments(self):
+        first = TestCounterModel.create()
+        second = TestCounterModel.create()
+        first.counter += 5
+        second.counter += 5
+        assert first.counter is first.counter
+        first.counter += 2000
+        assert first.counter == 2005
+        assert second.counter == 5
+        first.blind_increment('counter', 1)
+        assert first.counter == 2006
+        save()
+        clear()
+
+        new = TestCounterModel.get(partition=first.partition)
+        assert new.counter == 2006
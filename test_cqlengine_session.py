@@ -1,18 +1,45 @@
 from datetime import date, datetime
+import os
+import tempfile
+import threading
+import time
 import unittest
 import uuid
 from uuid import UUID
 
 from cqlengine import columns
+import cqlengine.connection
 from cqlengine.connection import get_cluster, setup
 from cqlengine.exceptions import ValidationError
 from cqlengine.management import create_keyspace, delete_keyspace
-from cqlengine.query import DoesNotExist
+from cqlengine.query import DoesNotExist, QueryException
 from cqlengine_session import (add_call_after_save, \
                                AttributeUnavailable, \
+                               bulk_import, \
+                               BulkLoader, \
                                clear, \
+                               ConcurrentSession, \
+                               get_session, \
+                               GroupCommitter, \
+                               Journal, \
+                               NegativeCache, \
+                               PartitionCache, \
+                               QueryCache, \
+                               replay_journal, \
                                save, \
-                               SessionModel)
+                               Session, \
+                               SessionModel, \
+                               set_lazy_models, \
+                               set_negative_cache, \
+                               set_partition_cache, \
+                               set_query_cache, \
+                               set_session_factory, \
+                               set_session_manager, \
+                               SharedSessionManager, \
+                               ThreadLocalSessionManager, \
+                               VALIDATE_KEYS, \
+                               VALIDATE_NONE, \
+                               wait)
 
 def groom_time(dtime):
     return datetime(*dtime.timetuple()[:6])
@@ -197,6 +224,21 @@ def make_instance_range_model():
 
     return Todo
 
+def make_event_model():
+    class Event(SessionModel):
+        user_id = columns.UUID(primary_key=True, default=uuid.uuid4)
+        seq = columns.Integer(primary_key=True, clustering_order='desc')
+        score = columns.Integer()
+
+    return Event
+
+def make_todo_ref_model():
+    class TodoRef(SessionModel):
+        uuid = columns.UUID(primary_key=True, default=uuid.uuid4)
+        todo_id = columns.UUID()
+
+    return TodoRef
+
 def make_todo_model_plus_extra():
     class Todo(SessionModel):
         uuid = columns.UUID(primary_key=True, default=uuid.uuid4)
@@ -208,6 +250,15 @@ def make_todo_model_plus_extra():
 
     return Todo
 
+def make_ttl_todo_model():
+    class Todo(SessionModel):
+        __default_ttl__ = 3600
+        uuid = columns.UUID(primary_key=True, default=uuid.uuid4)
+        title = columns.Text(max_length=60)
+        text = columns.Text()
+
+    return Todo
+
 
 class BaseTestCase(unittest.TestCase):
 
@@ -530,6 +581,19 @@ class BasicTestCase(BaseTestCase):
         else:
             self.assertTrue(False)
 
+    def test_clock_set_back(self):
+        todo = self.Todo.create(title='first', text='text1')
+        save()
+        todo.title = u'second'
+        clock = time.time
+        time.time = lambda: clock() - 1
+        try:
+            save()
+        finally:
+            time.time = clock
+        clear()
+        assert self.Todo.get(uuid=todo.uuid).title == u'second'
+
     def test_call_after_save(self):
         todo = self.Todo.create(title='first', text='text1')
         todo_key = todo.uuid
@@ -645,6 +709,35 @@ class BasicTestCase(BaseTestCase):
         assert self.Todo.id_mapped_class.objects(uuid=todo1_key).get().text == 'changed1'
         assert self.Todo.id_mapped_class.objects(uuid=todo2_key).get().text == 'changed2'
 
+    def test_single_save_foreign(self):
+        todo1 = self.Todo.create(title='first', text='text1')
+        todo1_key = todo1.uuid
+        clear()
+        todo2 = self.Todo.create(title='second', text='text2')
+        todo2_key = todo2.uuid
+
+        # todo1 belongs to the cleared session, so nothing is saved.
+        save(todo1)
+
+        for key in (todo1_key, todo2_key):
+            with self.assertRaises(DoesNotExist):
+                self.Todo.id_mapped_class.objects(uuid=key).get()
+
+    def test_single_save_dependencies(self):
+        todo1 = self.Todo.create(title='first', text='text1')
+        todo2 = self.Todo.create(title='second', text='text2')
+        todo3 = self.Todo.create(title='third', text='text3')
+        todo4 = self.Todo.create(title='fourth', text='text4')
+        todo1.depends_on(todo2)
+        todo2.depends_on(todo3, todo1)
+
+        save(todo1, dependencies=True)
+
+        assert self.Todo.id_mapped_class.objects(uuid=todo1.uuid).get()
+        assert self.Todo.id_mapped_class.objects(uuid=todo2.uuid).get()
+        assert self.Todo.id_mapped_class.objects(uuid=todo3.uuid).get()
+        with self.assertRaises(DoesNotExist):
+            self.Todo.id_mapped_class.objects(uuid=todo4.uuid).get()
 
     def test_promote(self):
         todo1 = self.Todo.create(title='first', text='text1')
@@ -653,6 +746,265 @@ class BasicTestCase(BaseTestCase):
         todo2 = self.Todo(todo1_key)
         todo2.promote(done=True)
 
+
+class ProjectionTestCase(BaseTestCase):
+
+    model_classes = {'Todo': make_todo_model}
+
+    def test_only(self):
+        todo = self.Todo.create(title='first', text='text1')
+        key = todo.uuid
+        save()
+        clear()
+
+        todo = self.Todo.objects.only(['title']).get(uuid=key)
+        assert todo.title == 'first'
+        assert todo.loaded_columns() == frozenset(['uuid', 'title'])
+        with self.assertRaises(AttributeUnavailable) as context:
+            todo.text
+        assert 'only()' in str(context.exception)
+
+        # A later full load fills in the rest.
+        self.Todo.get(uuid=key)
+        assert todo.text == 'text1'
+
+    def test_merge_keeps_dirty_values(self):
+        todo = self.Todo.create(title='first', text='text1')
+        key = todo.uuid
+        save()
+        clear()
+
+        todo = self.Todo.objects.only(['title']).get(uuid=key)
+        todo.title = u'changed'
+        assert self.Todo.objects.defer(['done']).get(uuid=key) is todo
+        assert todo.title == u'changed'
+        assert todo.text == 'text1'
+
+
+class QueryCacheTestCase(BaseTestCase):
+
+    model_classes = {'Todo': make_todo_model}
+
+    def setUp(self):
+        super(QueryCacheTestCase, self).setUp()
+        set_query_cache(QueryCache(ttl=60))
+
+    def tearDown(self):
+        set_query_cache(None)
+        super(QueryCacheTestCase, self).tearDown()
+
+    def test_cache(self):
+        todo = self.Todo.create(title='first', text='text1')
+        key = todo.uuid
+        save()
+        clear()
+
+        assert self.Todo.filter(uuid=key).get().title == 'first'
+        # Change the row behind the session's back.
+        self.Todo.id_mapped_class.objects(uuid=key).update(title='second')
+        clear()
+        todo = self.Todo.filter(uuid=key).get()
+        assert todo.title == 'first'
+        assert self.Todo.filter(uuid=key).get() is todo
+
+        # Saving to the table invalidates its queries.
+        self.Todo.create(title='other')
+        save()
+        clear()
+        assert self.Todo.filter(uuid=key).get().title == 'second'
+
+
+class NegativeCacheTestCase(BaseTestCase):
+
+    model_classes = {'Todo': make_todo_model}
+
+    def tearDown(self):
+        set_negative_cache(None)
+        super(NegativeCacheTestCase, self).tearDown()
+
+    def test_session(self):
+        key = uuid.uuid4()
+        with self.assertRaises(DoesNotExist):
+            self.Todo.get(uuid=key)
+        # Create the row behind the session's back; the session still
+        # remembers it missing.
+        self.Todo.id_mapped_class.create(uuid=key, title='first')
+        with self.assertRaises(DoesNotExist):
+            self.Todo.get(uuid=key)
+
+        self.Todo.create(uuid=key, title='second')
+        save()
+        assert self.Todo.get(uuid=key).title == 'second'
+
+    def test_shared(self):
+        set_negative_cache(NegativeCache(ttl=60))
+        key = uuid.uuid4()
+        with self.assertRaises(DoesNotExist):
+            self.Todo.get(uuid=key)
+        self.Todo.id_mapped_class.create(uuid=key, title='first')
+        clear()
+        with self.assertRaises(DoesNotExist):
+            self.Todo.get(uuid=key)
+
+        blind = self.Todo(key)
+        blind.text = u'written'
+        save()
+        clear()
+        assert self.Todo.get(uuid=key).title == 'first'
+
+
+class PartitionCacheTestCase(BaseTestCase):
+
+    model_classes = {'Event': make_event_model}
+
+    def setUp(self):
+        super(PartitionCacheTestCase, self).setUp()
+        set_partition_cache(PartitionCache(max_rows=3))
+
+    def tearDown(self):
+        set_partition_cache(None)
+        super(PartitionCacheTestCase, self).tearDown()
+
+    def test_latest(self):
+        user_id = uuid.uuid4()
+        for seq in range(5):
+            self.Event.create(user_id=user_id, seq=seq, score=seq)
+        save()
+        clear()
+        latest = self.Event.objects.filter(user_id=user_id).limit(2)
+        assert [e.seq for e in latest] == [4, 3]
+
+        # Rows written behind the session's back aren't seen.
+        self.Event.id_mapped_class.create(user_id=user_id, seq=9, score=9)
+        clear()
+        latest = self.Event.objects.filter(user_id=user_id).limit(2)
+        assert [e.seq for e in latest] == [4, 3]
+
+        # Rows created through a session are merged in.
+        self.Event.create(user_id=user_id, seq=10, score=10)
+        save()
+        clear()
+        latest = self.Event.objects.filter(user_id=user_id).limit(2)
+        assert [e.seq for e in latest] == [10, 4]
+
+        # Updates drop the partition.
+        latest[0].score = 11
+        save()
+        clear()
+        latest = self.Event.objects.filter(user_id=user_id).limit(2)
+        assert [(e.seq, e.score) for e in latest] == [(10, 11), (9, 9)]
+
+    def test_clone_of_cached_query(self):
+        user_id = uuid.uuid4()
+        for seq in range(3):
+            self.Event.create(user_id=user_id, seq=seq, score=seq)
+        save()
+        clear()
+        list(self.Event.objects.filter(user_id=user_id).limit(2))
+        clear()
+        cached = self.Event.objects.filter(user_id=user_id).limit(2)
+        assert [e.score for e in cached] == [2, 1]
+
+        self.Event.id_mapped_class.create(user_id=user_id, seq=2, score=20)
+        # Not a partition's first rows, so read from Cassandra, and merged.
+        fresh = cached.filter(seq__gte=0)
+        assert [e.score for e in fresh] == [20, 1]
+
+
+class PrefetchTestCase(BaseTestCase):
+
+    model_classes = {'Todo': make_todo_model,
+                     'TodoRef': make_todo_ref_model}
+
+    def test_prefetch(self):
+        todos = [self.Todo.create(title='todo{}'.format(i)) for i in range(3)]
+        refs = [self.TodoRef.create(todo_id=todo.uuid) for todo in todos]
+        missing_key = uuid.uuid4()
+        missing = self.TodoRef.create(todo_id=missing_key)
+        save()
+        clear()
+
+        keys = [ref.uuid for ref in refs] + [missing.uuid]
+        loaded = list(self.TodoRef.objects.filter(uuid__in=keys).prefetch(
+                self.Todo, via='todo_id'))
+        assert len(loaded) == 4
+        # Changes behind the session's back aren't seen: the rows are
+        # already in the identity map.
+        self.Todo.id_mapped_class.objects(uuid=todos[0].uuid).update(title='changed')
+        assert self.Todo(todos[0].uuid).title == 'todo0'
+        assert get_session().is_missing(self.Todo, (missing_key,))
+
+    def test_unknown_column(self):
+        with self.assertRaises(QueryException):
+            self.TodoRef.objects.prefetch(self.Todo, via='nope')
+
+
+class LazyModelTestCase(BaseTestCase):
+
+    def tearDown(self):
+        set_lazy_models(False)
+        super(LazyModelTestCase, self).tearDown()
+
+    def test_lazy(self):
+        class LazyTodo(SessionModel):
+            __lazy__ = True
+            uuid = columns.UUID(primary_key=True, default=uuid.uuid4)
+            title = columns.Text()
+        # Nothing is built until the class is used.
+        assert 'id_mapped_class' not in LazyTodo.__dict__
+        LazyTodo.sync_table()
+        assert 'id_mapped_class' in LazyTodo.__dict__
+
+        todo = LazyTodo.create(title=u'lazy')
+        save()
+        clear()
+        assert LazyTodo.get(uuid=todo.uuid).title == u'lazy'
+
+    def test_set_lazy_models(self):
+        set_lazy_models(True)
+        class LazyTodo(SessionModel):
+            uuid = columns.UUID(primary_key=True, default=uuid.uuid4)
+            title = columns.Text()
+        assert 'id_mapped_class' not in LazyTodo.__dict__
+        LazyTodo.sync_table()
+        todo = LazyTodo(uuid.uuid4())
+        assert isinstance(todo, LazyTodo)
+        assert LazyTodo(todo.uuid) is todo
+
+
+class LocalQueryTestCase(BaseTestCase):
+
+    model_classes = {'Todo': make_multi_key_model}
+
+    def test_covered_partition(self):
+        partition = uuid.uuid4()
+        first = self.Todo.create(partition=partition, title=u'first')
+        second = self.Todo.create(partition=partition, title=u'second')
+        save()
+        clear()
+        assert len(list(self.Todo.objects.filter(partition=partition))) == 2
+
+        # A row written behind the session's back isn't seen: the
+        # partition is answered from the identity map.
+        self.Todo.id_mapped_class.create(partition=partition, title=u'third')
+        todos = list(self.Todo.objects.filter(partition=partition))
+        assert set(todos) == set([first, second])
+        todo = self.Todo.objects.filter(partition=partition, uuid=first.uuid).get()
+        assert todo.title == u'first'
+
+        created = self.Todo.create(partition=partition, title=u'fourth')
+        assert created in list(self.Todo.objects.filter(partition=partition))
+
+    def test_limit_not_covered(self):
+        partition = uuid.uuid4()
+        self.Todo.create(partition=partition, title=u'first')
+        self.Todo.create(partition=partition, title=u'second')
+        save()
+        clear()
+        assert len(list(self.Todo.objects.filter(partition=partition).limit(1))) == 1
+        assert len(list(self.Todo.objects.filter(partition=partition))) == 2
+
+
 class TestDefaultCase(BaseTestCase):
 
     model_classes = {'Todo': make_default_todo_model}
@@ -787,6 +1139,47 @@ class TestRequiredCase(BaseTestCase):
         assert m2.mapcol == {'a': 22}
 
 
+class ValidationLevelTestCase(BaseTestCase):
+
+    model_classes = {'Todo': make_todo_model,
+                     'Range': make_instance_range_model}
+
+    def test_validate_all(self):
+        self.Todo.create(title='x' * 61)
+        with self.assertRaises(ValidationError):
+            save()
+
+    def test_validate_keys(self):
+        todo = self.Todo.create(title='x' * 61)
+        save(validation=VALIDATE_KEYS)
+        clear()
+        assert self.Todo.get(uuid=todo.uuid).title == 'x' * 61
+
+        self.Range.create()
+        with self.assertRaises(ValidationError):
+            save(validation=VALIDATE_KEYS)
+
+    def test_validate_none(self):
+        set_session_factory(lambda: Session(validation=VALIDATE_NONE))
+        try:
+            clear()
+            todo = self.Todo.create(title='x' * 61)
+            save()
+            clear()
+            assert self.Todo.get(uuid=todo.uuid).title == 'x' * 61
+
+            self.Todo.create(title='x' * 61)
+            with self.assertRaises(ValidationError):
+                save(validate_sample=1.0)
+        finally:
+            set_session_factory(Session)
+            clear()
+
+    def test_unknown_level(self):
+        with self.assertRaises(ValueError):
+            get_session().save(validation='some')
+
+
 class NoDefaultTestCase(BaseTestCase):
 
     model_classes = {'Todo': make_no_default_todo_model}
@@ -954,6 +1347,501 @@ class InstanceValidationTestCase(BaseTestCase):
         assert todo.col456 == 5
 
 
+class TTLTestCase(BaseTestCase):
+
+    model_classes = {'Todo': make_ttl_todo_model}
+
+    def get_write_info(self, key):
+        query = 'SELECT TTL("title") AS title_ttl, WRITETIME("title") AS title_time, WRITETIME("text") AS text_time FROM {} WHERE "uuid" = %(uuid)s'.format(
+                self.Todo.id_mapped_class.column_family_name())
+        return cqlengine.connection.execute(query, {'uuid': key})[0]
+
+    def test_default_ttl(self):
+        todo = self.Todo.create(title='first', text='text1')
+        other = self.Todo.create(title='second', text='text2')
+        save()
+        info = self.get_write_info(todo.uuid)
+        assert 0 < info['title_ttl'] <= 3600
+        # Every statement of one flush shares the client timestamp.
+        assert info['title_time'] == info['text_time']
+        assert info['title_time'] == self.get_write_info(other.uuid)['title_time']
+
+    def test_instance_ttl(self):
+        todo = self.Todo.create(title='first', text='text1')
+        todo.ttl(60)
+        save()
+        info = self.get_write_info(todo.uuid)
+        assert 0 < info['title_ttl'] <= 60
+
+        # The override only applies to the next save.
+        todo.title = u'second'
+        save()
+        info = self.get_write_info(todo.uuid)
+        assert 60 < info['title_ttl'] <= 3600
+
+    def test_update_after_delete_column(self):
+        todo = self.Todo.create(title='first', text='text1')
+        save()
+        first_time = self.get_write_info(todo.uuid)['text_time']
+        todo.title = None
+        todo.text = u'text2'
+        save()
+        info = self.get_write_info(todo.uuid)
+        assert info['title_time'] is None
+        assert info['text_time'] > first_time
+        clear()
+        todo = self.Todo.get(uuid=todo.uuid)
+        assert todo.title is None
+        assert todo.text == u'text2'
+
+    def test_replayed_ttl(self):
+        saved = self.Todo.create(title='first', text='text1')
+        save()
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        set_session_factory(lambda: Session(journal=Journal(path)))
+        try:
+            clear()
+            todo = self.Todo.create(title='second', text='text2').ttl(60)
+            updated = self.Todo(saved.uuid).ttl(30)
+            updated.title = u'changed'
+
+            # Lose the session without saving it, as a crash would.
+            set_session_factory(Session)
+            clear()
+            assert replay_journal(path, self.Todo) == 4
+        finally:
+            set_session_factory(Session)
+            clear()
+            os.remove(path)
+        assert 0 < self.get_write_info(todo.uuid)['title_ttl'] <= 60
+        assert 0 < self.get_write_info(saved.uuid)['title_ttl'] <= 30
+
+
+class DeleteTestCase(BaseTestCase):
+
+    model_classes = {'Todo': make_todo_model,
+                     'MultiTodo': make_multi_key_model}
+
+    def test_delete(self):
+        todo1 = self.Todo.create(title='first', text='text1')
+        todo1_key = todo1.uuid
+        todo2 = self.Todo.create(title='second', text='text2')
+        todo2_key = todo2.uuid
+        save()
+
+        todo1.delete()
+        # The delete waits for the next save.
+        assert self.Todo.id_mapped_class.objects(uuid=todo1_key).get()
+        # But the instance leaves the identity map right away.
+        self.assertIsNot(self.Todo(todo1_key), todo1)
+        save()
+
+        with self.assertRaises(DoesNotExist):
+            self.Todo.id_mapped_class.objects(uuid=todo1_key).get()
+        assert self.Todo.id_mapped_class.objects(uuid=todo2_key).get()
+
+    def test_delete_then_create(self):
+        todo = self.Todo.create(title='first', text='text1')
+        todo_key = todo.uuid
+        save()
+
+        todo.delete()
+        todo = self.Todo.create(uuid=todo_key, title='again')
+        save()
+        clear()
+
+        todo = self.Todo.get(uuid=todo_key)
+        assert todo.title == u'again'
+        assert todo.text is None
+
+    def test_delete_unsaved(self):
+        todo = self.Todo.create(title='first', text='text1')
+        todo_key = todo.uuid
+        todo.delete()
+        save()
+
+        with self.assertRaises(DoesNotExist):
+            self.Todo.id_mapped_class.objects(uuid=todo_key).get()
+
+    def test_delete_column(self):
+        todo = self.Todo.create(title='first', text='text1')
+        todo_key = todo.uuid
+        save()
+
+        del todo.title
+        assert todo.title is None
+        save()
+        clear()
+
+        todo = self.Todo.get(uuid=todo_key)
+        assert todo.title is None
+        assert todo.text == u'text1'
+        with self.assertRaises(AttributeError):
+            del todo.uuid
+
+    def test_delete_partition(self):
+        todo1 = self.MultiTodo.create(title='first')
+        partition = todo1.partition
+        todo2 = self.MultiTodo.create(partition=partition, title='second')
+        other = self.MultiTodo.create(title='other')
+        save()
+
+        todo1.delete()
+        get_session().delete_range(self.MultiTodo, partition=partition)
+        self.assertIsNot(self.MultiTodo(*todo2.key), todo2)
+        self.assertIs(self.MultiTodo(*other.key), other)
+        save()
+        clear()
+
+        assert len(self.MultiTodo.filter(partition=partition)) == 0
+        assert len(self.MultiTodo.filter(partition=other.partition)) == 1
+
+    def test_delete_range_validation(self):
+        with self.assertRaises(QueryException):
+            get_session().delete_range(self.MultiTodo, uuid=uuid.uuid4())
+        with self.assertRaises(QueryException):
+            get_session().delete_range(self.MultiTodo,
+                                       partition=uuid.uuid4(),
+                                       pub_date=now())
+        with self.assertRaises(QueryException):
+            get_session().delete_range(self.MultiTodo,
+                                       partition=uuid.uuid4(),
+                                       title=u'first')
+
+
+class JournalTestCase(BaseTestCase):
+
+    model_classes = {'Todo': make_todo_model,
+                     'Counter': make_counter_model}
+
+    def setUp(self):
+        super(JournalTestCase, self).setUp()
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+        set_session_factory(lambda: Session(journal=Journal(self.path)))
+        clear()
+
+    def tearDown(self):
+        set_session_factory(Session)
+        clear()
+        os.remove(self.path)
+        super(JournalTestCase, self).tearDown()
+
+    def test_replay(self):
+        saved = self.Todo.create(title='saved', text='text0')
+        save()
+        assert os.path.getsize(self.path) == 0
+
+        todo = self.Todo.create(title='first', text='text1')
+        todo_key = todo.uuid
+        todo.title = u'changed'
+        saved.text = u'changed text'
+        counter = self.Counter.create()
+        counter.counter += 3
+        counter.counter += 2
+        assert os.path.getsize(self.path) > 0
+
+        # Lose the session without saving it, as a crash would.
+        set_session_factory(Session)
+        clear()
+        assert replay_journal(self.path, self.Todo, self.Counter) == 6
+        assert os.path.getsize(self.path) == 0
+        clear()
+
+        todo = self.Todo.get(uuid=todo_key)
+        assert todo.title == u'changed'
+        assert todo.text == u'text1'
+        assert self.Todo.get(uuid=saved.uuid).text == u'changed text'
+        counter = self.Counter.get(partition=counter.partition,
+                                   cluster=counter.cluster)
+        assert counter.counter == 5
+
+    def test_selective_save(self):
+        todo1 = self.Todo.create(title='first', text='text1')
+        todo2 = self.Todo.create(title='second', text='text2')
+        save(todo1)
+
+        # Only todo2's create is left in the journal.
+        set_session_factory(Session)
+        clear()
+        assert replay_journal(self.path, self.Todo) == 1
+        assert self.Todo.get(uuid=todo2.uuid).title == u'second'
+
+    def test_torn_record(self):
+        self.Todo.create(title='first', text='text1')
+        with open(self.path, 'ab') as journal_file:
+            journal_file.write('\x02\x00\x00')
+        set_session_factory(Session)
+        clear()
+        assert replay_journal(self.path, self.Todo) == 1
+
+    def test_failed_save(self):
+        todo = self.Todo.create(title='first', text='text1')
+        counter = self.Counter.create()
+        counter.counter += 2
+        session = cqlengine.connection.session
+        cqlengine.connection.session = None
+        try:
+            with self.assertRaises(Exception):
+                save()
+        finally:
+            cqlengine.connection.session = session
+        assert todo._created
+        assert counter._created
+        assert os.path.getsize(self.path) > 0
+        save()
+        clear()
+
+        assert self.Todo.get(uuid=todo.uuid).title == u'first'
+        counter = self.Counter.get(partition=counter.partition,
+                                   cluster=counter.cluster)
+        assert counter.counter == 2
+
+
+class GroupCommitTestCase(BaseTestCase):
+
+    model_classes = {'Todo': make_todo_model,
+                     'Counter': make_counter_model}
+
+    def setUp(self):
+        super(GroupCommitTestCase, self).setUp()
+        committer = GroupCommitter(window=0.05)
+        set_session_factory(lambda: Session(group_commit=committer))
+
+    def tearDown(self):
+        set_session_factory(Session)
+        clear()
+        super(GroupCommitTestCase, self).tearDown()
+
+    def test_concurrent_saves(self):
+        todo_keys = {}
+        counter_keys = {}
+        errors = []
+        def work(i):
+            try:
+                clear()
+                todo_keys[i] = self.Todo.create(title='todo{}'.format(i)).uuid
+                counter = self.Counter.create()
+                counter.counter += i
+                counter_keys[i] = (counter.partition, counter.cluster)
+                save()
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+
+        clear()
+        for i in range(8):
+            assert self.Todo.get(uuid=todo_keys[i]).title == 'todo{}'.format(i)
+            partition, cluster = counter_keys[i]
+            counter = self.Counter.get(partition=partition, cluster=cluster)
+            assert counter.counter == i
+
+    def test_error(self):
+        self.Todo.create(title='first', text='text1')
+        session = cqlengine.connection.session
+        cqlengine.connection.session = None
+        try:
+            with self.assertRaises(Exception):
+                save()
+        finally:
+            cqlengine.connection.session = session
+
+    def test_error_reaches_followers(self):
+        errors = []
+        def work(i):
+            try:
+                clear()
+                self.Todo.create(title='todo{}'.format(i))
+                save()
+            except Exception, e:
+                errors.append(e)
+        def unavailable():
+            raise RuntimeError('no session')
+        get_cassandra_session = cqlengine.connection.get_session
+        cqlengine.connection.get_session = unavailable
+        try:
+            threads = [threading.Thread(target=work, args=(i,)) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            cqlengine.connection.get_session = get_cassandra_session
+        assert len(errors) == 4
+
+    def test_nothing_to_save(self):
+        session = Session(group_commit=GroupCommitter(window=10))
+        start = time.time()
+        session.save()
+        # Returns without waiting out the window.
+        assert time.time() - start < 1
+
+
+class WriteBehindTestCase(BaseTestCase):
+
+    model_classes = {'Todo': make_todo_model,
+                     'Counter': make_counter_model}
+
+    def setUp(self):
+        super(WriteBehindTestCase, self).setUp()
+        set_session_factory(lambda: Session(write_behind=True))
+        clear()
+
+    def tearDown(self):
+        set_session_factory(Session)
+        clear()
+        super(WriteBehindTestCase, self).tearDown()
+
+    def test_save(self):
+        todo = self.Todo.create(title='first', text='text1')
+        counter = self.Counter.create()
+        counter.counter += 2
+        future = save()
+        # Changed while the flush may still be running.
+        todo.title = u'second'
+        future.result()
+        assert todo._dirties == {'title': u'second'}
+        save()
+        wait()
+        clear()
+
+        assert self.Todo.get(uuid=todo.uuid).title == u'second'
+        counter = self.Counter.get(partition=counter.partition,
+                                   cluster=counter.cluster)
+        assert counter.counter == 2
+
+    def test_failed_flush(self):
+        todo = self.Todo.create(title='first', text='text1')
+        counter = self.Counter.create()
+        counter.counter += 2
+        session = cqlengine.connection.session
+        cqlengine.connection.session = None
+        try:
+            save()
+            counter.counter += 3
+            with self.assertRaises(Exception):
+                wait()
+        finally:
+            cqlengine.connection.session = session
+        assert todo._created
+        assert counter._created
+        save()
+        wait()
+        clear()
+
+        assert self.Todo.get(uuid=todo.uuid).title == u'first'
+        counter = self.Counter.get(partition=counter.partition,
+                                   cluster=counter.cluster)
+        assert counter.counter == 5
+
+
+class ConcurrentSessionTestCase(BaseTestCase):
+
+    model_classes = {'Todo': make_todo_model,
+                     'Counter': make_counter_model}
+
+    def setUp(self):
+        super(ConcurrentSessionTestCase, self).setUp()
+        set_session_manager(SharedSessionManager())
+
+    def tearDown(self):
+        set_session_manager(ThreadLocalSessionManager())
+        super(ConcurrentSessionTestCase, self).tearDown()
+
+    def test_shared_instances(self):
+        todo = self.Todo.create(title='first', text='text1')
+        counter = self.Counter.create()
+        save()
+        found = []
+        calls = []
+
+        def work():
+            instance = self.Todo(todo.uuid)
+            found.append(instance)
+            for i in xrange(100):
+                self.Counter(counter.partition, counter.cluster).blind_increment('counter', 1)
+                if i % 25 == 0:
+                    add_call_after_save(calls.append, i)
+                    save()
+
+        threads = [threading.Thread(target=work) for i in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        save()
+        assert all(instance is todo for instance in found)
+        assert len(calls) == 16
+        clear()
+
+        assert isinstance(get_session(), ConcurrentSession)
+        counter = self.Counter.get(partition=counter.partition,
+                                   cluster=counter.cluster)
+        assert counter.counter == 400
+
+    def test_journal(self):
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        journal = Journal(path)
+        try:
+            with self.assertRaises(ValueError):
+                ConcurrentSession(journal=journal)
+        finally:
+            journal.close()
+            os.remove(path)
+
+
+class BulkLoaderTestCase(BaseTestCase):
+
+    model_classes = {'Todo': make_todo_model,
+                     'Range': make_instance_range_model}
+
+    def test_create(self):
+        keys = []
+        with BulkLoader(batch_size=7, buffer_size=20) as loader:
+            for i in range(50):
+                key = uuid.uuid4()
+                keys.append(key)
+                loader.create(self.Todo, uuid=key, title='todo{}'.format(i))
+        assert loader.result.rows == 50
+        assert loader.result.errors == 0
+        assert get_session().instances_by_class == {}
+
+        for i, key in enumerate(keys):
+            todo = self.Todo.get(uuid=key)
+            assert todo.title == 'todo{}'.format(i)
+            assert todo.text is None
+
+    def test_validation(self):
+        with BulkLoader() as loader:
+            with self.assertRaises(ValidationError):
+                loader.create(self.Todo, nope='x')
+            with self.assertRaises(ValidationError):
+                loader.create(self.Range, col456=7)
+            loader.create(self.Range, col456=5)
+        assert loader.result.rows == 1
+
+    def test_bulk_import(self):
+        keys = [uuid.uuid4() for i in range(100)]
+        rows = [{'uuid': key, 'title': 'todo{}'.format(i)}
+                for i, key in enumerate(keys)]
+        rows.append({'title': 'no such column', 'nope': 1})
+        result = bulk_import(self.Todo, rows, ['localhost'], self.keyspace,
+                             processes=3, chunk_size=10)
+        assert result.rows == 100
+        assert result.invalid_rows == 1
+        assert result.errors == 0
+
+        for i, key in enumerate(keys):
+            assert self.Todo.get(uuid=key).title == 'todo{}'.format(i)
+
+
 class ExtraColumnsTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -1,10 +1,12 @@
 from datetime import date, datetime
+import time
 import uuid
 from uuid import UUID
 
 from cqlengine import columns
 from cqlengine_session import (add_call_after_save, \
                                AttributeUnavailable, \
+                               BulkLoader, \
                                clear, \
                                save, \
                                SessionModel)
@@ -40,11 +42,19 @@ def make_bar_model():
 
     return Bar
 
+def make_baz_model():
+    class Baz(SessionModel):
+        user_id = columns.UUID(primary_key=True, default=uuid.uuid4)
+        counter = columns.Counter()
+
+    return Baz
+
 
 class SpeedTestCase(BaseTestCase):
 
     model_classes = {'Foo': make_foo_model,
-                     'Bar': make_bar_model}
+                     'Bar': make_bar_model,
+                     'Baz': make_baz_model}
 
     # change 'disabled' to 'test' and a profile will be saved to 'cqesstats'
     def disabled_insert_speed(self):
@@ -71,4 +81,59 @@ class SpeedTestCase(BaseTestCase):
         # run this on the command line to see the profile
         # echo 'import pstats;p = pstats.Stats("cqesstats");p.sort_stats("cumulative").print_stats(10)' | python
 
+    # change 'disabled' to 'test' to print the bulk loader's throughput
+    def disabled_bulk_insert_speed(self):
+        pub_date = datetime.now()
+        with BulkLoader() as loader:
+            for i in xrange(100000):
+                loader.create(
+                    self.Foo,
+                    created_on=pub_date,
+                    record_id=i,
+                    score=i
+                )
+                loader.create(
+                    self.Bar,
+                    delta_type=i,
+                    from_user=True,
+                    contact_id=uuid.uuid4(),
+                    contact_type=i,
+                    record_id=i,
+                    score=i
+                )
+        print loader.result
+
+    # change 'disabled' to 'test' to print the cost of declaring models
+    def disabled_model_creation_speed(self):
+        started = time.time()
+        for i in xrange(300):
+            make_foo_model()
+            make_bar_model()
+        elapsed = time.time() - started
+        print '600 models declared in {:.3f}s ({:.2f}ms each)'.format(
+                elapsed, elapsed / 600 * 1000)
+
+    # change 'disabled' to 'test' to print the cost of building instances
+    # from rows and of reading counters
+    def disabled_construct_speed(self):
+        rows = [{'user_id': uuid.uuid4(),
+                 'contact_id': uuid.uuid4(),
+                 'created_on': now(),
+                 'contact_types': {1, 2},
+                 'record_id': i,
+                 'score': i} for i in xrange(10000)]
+        started = time.time()
+        for row in rows:
+            self.Foo._construct_instance(row)
+        elapsed = time.time() - started
+        print '10000 instances built in {:.3f}s ({:.2f}us each)'.format(
+                elapsed, elapsed / 10000 * 1000000)
 
+        instance = self.Baz.create()
+        instance.counter += 5
+        started = time.time()
+        for i in xrange(100000):
+            instance.counter
+        elapsed = time.time() - started
+        print '100000 counter reads in {:.3f}s ({:.2f}us each)'.format(
+                elapsed, elapsed / 100000 * 1000000)
@@ -1,15 +1,27 @@
 from datetime import date, datetime
+import json
+import os
+import sys
+import tempfile
+import types
 import unittest
 import uuid
 from uuid import UUID
 
-from cqlengine import columns
+from cqlengine import columns, models
 import cqlengine.connection
 from cqlengine.connection import get_cluster, setup
 from cqlengine.management import create_keyspace, delete_keyspace, sync_table
 from cqlengine.models import Model
 from cqlengine.query import DoesNotExist
-from cqlengine_session import verify
+from cqlengine_session import (_module_models, \
+                               _schema_layout, \
+                               main, \
+                               SchemaLayout, \
+                               SchemaSnapshot, \
+                               SessionModel, \
+                               SYSTEM_SCHEMA, \
+                               verify)
 
 def make_model(table_name, skip={}, different={}, index={'text_index': True}):
     def get_col(name, col, args=(), kwargs={}):
@@ -74,6 +86,10 @@ def make_counter_model(table_name, skip={}, different={}, index={'text_index': T
     return TestCountTable
 
 
+# Found by main() when it is given this module.
+MainModel = make_model(table_name='main_model')
+
+
 class VerifyTest(unittest.TestCase):
 
     def setUp(self):
@@ -388,3 +404,152 @@ class VerifyTest(unittest.TestCase):
         results = verify(Foo)
         assert len(results) == 0
 
+    def test_snapshot(self):
+        Foo = make_model(table_name='foo_bar')
+        sync_table(Foo)
+
+        snapshot = SchemaSnapshot()
+        assert not verify(Foo, snapshot=snapshot)
+        # The snapshot is not read again, so it doesn't see the new table.
+        Bar = make_model(table_name='baz_qux')
+        sync_table(Bar)
+        assert not verify(Foo, snapshot=snapshot)
+        assert len(verify(Foo)) == 1
+
+    def test_snapshot_layout(self):
+        Foo = make_model(table_name='foo_bar')
+        sync_table(Foo)
+        found = _schema_layout()
+        read = []
+
+        class Layout(SchemaLayout):
+            queries = found.queries
+
+            def tables(self, *results):
+                read.append(results)
+                return found.tables(*results)
+
+        # The given layout is used even though the driver has metadata.
+        assert not verify(Foo, snapshot=SchemaSnapshot(Layout()))
+        assert len(read) == 1
+
+    def test_cache_file(self):
+        Foo = make_model(table_name='foo_bar')
+        sync_table(Foo)
+        Foo2 = make_model(table_name='foo_bar', skip=set(['title']))
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            results = verify(Foo2, cache_file=path)
+            assert len(results) == 1
+            # Read back from the file.
+            results = verify(Foo2, cache_file=path)
+            assert len(results) == 1
+            assert results[0].model is Foo2
+            assert results[0].extra == set(['title'])
+            # Other models are verified again.
+            assert not verify(Foo, cache_file=path)
+        finally:
+            os.remove(path)
+
+    def test_two_keyspaces(self):
+        other_keyspace = '{}b'.format(self.keyspace)
+        create_keyspace(other_keyspace)
+        try:
+            Foo = make_model(table_name='foo_bar')
+            sync_table(Foo)
+            Bar = make_model(table_name='foo_bar', skip=set(['title']))
+            Bar.__keyspace__ = other_keyspace
+            sync_table(Bar)
+
+            # Each model is checked against its own keyspace.
+            assert not verify(Foo, Bar)
+            Bar2 = make_model(table_name='foo_bar')
+            Bar2.__keyspace__ = other_keyspace
+            results = verify(Foo, Bar2)
+            assert len(results) == 1
+            assert results[0].model is Bar2
+            assert results[0].missing == set(['title'])
+        finally:
+            delete_keyspace(other_keyspace)
+
+    def test_system_schema_layout(self):
+        def column(name, kind, position, cql_type, clustering_order='none'):
+            return {'table_name': 'foo_bar', 'column_name': name, 'kind': kind,
+                    'position': position, 'type': cql_type,
+                    'clustering_order': clustering_order}
+        tables = SYSTEM_SCHEMA.tables(
+                [column('b', 'partition_key', 1, 'text'),
+                 column('a', 'partition_key', 0, 'uuid'),
+                 column('c', 'clustering', 0, 'int', 'desc'),
+                 column('d', 'regular', -1, 'map<text, frozen<list<int>>>')],
+                [{'table_name': 'foo_bar', 'index_name': 'foo_bar_d_idx',
+                  'options': {'target': 'keys(d)'}}])
+        marshal = 'org.apache.cassandra.db.marshal.'
+        table = tables['foo_bar']
+        assert table['partition_keys'] == ['a', 'b']
+        assert table['partition_key_types'] == [marshal + 'UUIDType', marshal + 'UTF8Type']
+        assert table['primary_keys'] == ['c']
+        assert table['primary_key_types'] == [marshal + 'ReversedType(' + marshal + 'Int32Type)']
+        assert table['fields'] == {
+            'd': '{0}MapType({0}UTF8Type,{0}FrozenType({0}ListType({0}Int32Type)))'.format(marshal)}
+        assert table['indexes'] == set(['d'])
+
+    def test_main(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            args = ['test_verify', '--keyspace', self.keyspace, '--output', path]
+            cluster = get_cluster()
+            default_keyspace = models.DEFAULT_KEYSPACE
+            main(args + ['--keyspace', 'other_keyspace'])
+            # main() closes its own connection, and leaves ours.
+            assert get_cluster() is cluster
+            assert models.DEFAULT_KEYSPACE == default_keyspace
+            assert main(args) == 1
+            with open(path) as f:
+                report = json.load(f)
+            assert not report['ok']
+            [model] = report['models']
+            assert model['class'] == 'test_verify.MainModel'
+            assert model['differences']['is_missing']
+
+            sync_table(MainModel)
+            assert main(args) == 0
+            with open(path) as f:
+                report = json.load(f)
+            assert report['ok']
+            assert report['models'][0]['differences'] is None
+            assert report['schema_seconds'] is not None
+
+            assert main(args + ['--cache-file', path + '.cache']) == 0
+            with open(path) as f:
+                report = json.load(f)
+            assert report['schema_seconds'] is None
+            os.remove(path + '.cache')
+
+            with self.assertRaises(SystemExit):
+                main(args + ['--cache-file', path + '.cache', '--serial'])
+        finally:
+            os.remove(path)
+
+    def test_module_models(self):
+        module = types.ModuleType('verify_models')
+        sys.modules['verify_models'] = module
+        try:
+            class Foo(SessionModel):
+                __module__ = 'verify_models'
+                key = columns.UUID(primary_key=True)
+
+            class Zed(SessionModel):
+                __module__ = 'verify_models'
+                key = columns.UUID(primary_key=True)
+
+            module.Foo = Foo
+            module.Zed = Zed
+            found = _module_models(module)
+            assert found == {Foo.id_mapped_class: 'verify_models.Foo',
+                              Zed.id_mapped_class: 'verify_models.Zed'}
+        finally:
+            del sys.modules['verify_models']